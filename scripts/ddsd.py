@@ -21,8 +21,21 @@ from modules.processing import (
 from modules.scripts import AlwaysVisible
 from modules.sd_models import model_hash
 from modules.shared import opts, state
+from scripts.ddsd_cond import cond_cache_begin, cond_cache_end
 from scripts.ddsd_dino import dino_model_list
-from scripts.ddsd_sam import sam_model_list
+from scripts.ddsd_expr import ExprJob, compile_expression, expression_peak, expression_report
+from scripts.ddsd_mask import region_mask, region_unwrap
+from scripts.ddsd_region import (
+    latent_carry_bind,
+    latent_carry_report,
+    region_batch_inpaint,
+    region_batches,
+    region_clusters,
+    region_report,
+    regional_groups,
+    regional_inpaint,
+)
+from scripts.ddsd_sam import sam_fast_iou_report, sam_memo_report, sam_model_list
 from scripts.ddsd_utils import (
     I2I_Generator_Create,
     dino_detect_from_prompt,
@@ -159,6 +172,7 @@ class Script(modules.scripts.Script):
         dino_detection_steps_list = []
         dino_detection_spliter_disable_list = []
         dino_detection_spliter_remove_area_list = []
+        dino_detection_sam_size_list = []
         watermark_type_list = []
         watermark_position_list = []
         watermark_image_gr_list = []
@@ -365,7 +379,7 @@ class Script(modules.scripts.Script):
                                     elem_id=f"detailer_detect_prompt_{index + 1}",
                                     show_label=True,
                                     lines=2,
-                                    placeholder="Detect Token Prompt(ex - face:level(0-2):threshold(0-1):dilation(0-128))",
+                                    placeholder="Detect Token Prompt(ex - face:level(0-2):threshold(0-1):dilation(0-128):mode(SAM/RECT/ELLIPSE/ROUND))",
                                     visible=True,
                                 )
                                 with gr.Row():
@@ -426,6 +440,13 @@ class Script(modules.scripts.Script):
                                     value=16,
                                     visible=True,
                                 )
+                                dino_detection_sam_size = gr.Radio(
+                                    choices=["1024", "640", "512"],
+                                    value="1024",
+                                    label=f"DINO {index + 1} SAM Encoder Size",
+                                    elem_id=f"dino_detect_{index+1}_sam_size",
+                                    visible=True,
+                                )
                                 dino_detection_ckpt_list.append(dino_detection_ckpt)
                                 dino_detection_vae_list.append(dino_detection_vae)
                                 dino_detection_prompt_list.append(dino_detection_prompt)
@@ -446,6 +467,9 @@ class Script(modules.scripts.Script):
                                 dino_detection_spliter_remove_area_list.append(
                                     dino_detection_spliter_remove_area
                                 )
+                                dino_detection_sam_size_list.append(
+                                    dino_detection_sam_size
+                                )
                         dino_tabs = dino_tabs_acc
                     dino_full_res_inpaint = gr.Checkbox(
                         label="Inpaint at full resolution ",
@@ -925,6 +949,7 @@ class Script(modules.scripts.Script):
             + dino_detection_steps_list
             + dino_detection_spliter_disable_list
             + dino_detection_spliter_remove_area_list
+            + dino_detection_sam_size_list
             + watermark_type_list
             + watermark_position_list
             + watermark_image_list
@@ -963,8 +988,72 @@ class Script(modules.scripts.Script):
         dino_detection_steps_list,
         dino_detection_spliter_disable_list,
         dino_detection_spliter_remove_area_list,
+        dino_detection_sam_size_list,
     ):
-        for detect_index in range(dino_detect_count):
+        detect_job = ExprJob(
+            [
+                compile_expression(dino_detection_prompt_list[detect_index])
+                for detect_index in range(dino_detect_count)
+                if len(dino_detection_prompt_list[detect_index]) > 0
+            ]
+        )
+        regional = (
+            regional_groups(
+                dino_detection_prompt_list[:dino_detect_count],
+                [
+                    dino_detection_positive_list[detect_index]
+                    if dino_detection_positive_list[detect_index]
+                    else self.target_prompts
+                    for detect_index in range(dino_detect_count)
+                ],
+                [
+                    dino_detection_negative_list[detect_index]
+                    if dino_detection_negative_list[detect_index]
+                    else self.target_negative_prompts
+                    for detect_index in range(dino_detect_count)
+                ],
+                [
+                    (
+                        dino_detection_ckpt_list[detect_index],
+                        dino_detection_vae_list[detect_index],
+                        dino_detection_denoise_list[detect_index],
+                        dino_detection_cfg_list[detect_index],
+                        dino_detection_steps_list[detect_index],
+                        dino_detection_spliter_disable_list[detect_index],
+                    )
+                    for detect_index in range(dino_detect_count)
+                ],
+                [
+                    not dino_detection_spliter_disable_list[detect_index]
+                    or len(dino_detection_prompt_list[detect_index]) > 0
+                    and compile_expression(
+                        dino_detection_prompt_list[detect_index]
+                    ).max_regions
+                    > 0
+                    for detect_index in range(dino_detect_count)
+                ],
+            )
+            if shared.opts.data.get("ddsd_regional_prompting", False)
+            else {}
+        )
+        regional_pending = []
+        for detect_index in range(dino_detect_count + 1):
+            if regional_pending and (
+                detect_index == dino_detect_count
+                or regional.get(detect_index) != regional[regional_pending[0][0]]
+            ):
+                state.job_count += 1
+                init_image, processed = regional_inpaint(
+                    init_image,
+                    [(member, mask) for _, member, mask in regional_pending],
+                    self.target_seeds + regional_pending[0][0],
+                )
+                p.extra_generation_params[
+                    f"DINO {regional_pending[0][0] + 1} Regional"
+                ] = ", ".join(str(index + 1) for index, _, _ in regional_pending)
+                regional_pending = []
+            if detect_index == dino_detect_count:
+                break
             self.change_ckpt_model(
                 dino_detection_ckpt_list[detect_index]
                 if dino_detection_ckpt_list[detect_index] != "Original"
@@ -1020,6 +1109,8 @@ class Script(modules.scripts.Script):
                 or isinstance(p, StableDiffusionProcessingTxt2Img),
                 inpaint_mask_mode,
                 getattr(p, "image_mask", None),
+                int(dino_detection_sam_size_list[detect_index]),
+                detect_job,
             )
             if mask is not None:
                 # # yommi
@@ -1053,46 +1144,72 @@ class Script(modules.scripts.Script):
                         continue
                 ##
 
-                if not dino_detection_spliter_disable_list[detect_index]:
+                if detect_index in regional:
+                    regional_pending.append((detect_index, pi, mask))
+                elif not dino_detection_spliter_disable_list[detect_index]:
                     mask = mask_spliter_and_remover(
-                        mask, dino_detection_spliter_remove_area_list[detect_index]
+                        mask,
+                        dino_detection_spliter_remove_area_list[detect_index],
+                        compile_expression(
+                            dino_detection_prompt_list[detect_index]
+                        ).max_regions,
                     )
-                    for mask_index, mask_split in enumerate(mask):
-                        pi.seed = self.target_seeds + mask_index + detect_index
-                        pi.init_images = [init_image]
-                        pi.image_mask = Image.fromarray(mask_split)
-                        if shared.opts.data.get(
-                            "save_ddsd_working_on_dino_mask_images", False
-                        ):
-                            images.save_image(
-                                pi.image_mask,
-                                p.outpath_samples,
-                                shared.opts.data.get(
-                                    "save_ddsd_working_on_dino_mask_images_prefix", ""
-                                ),
-                                pi.seed,
-                                self.target_prompts,
-                                opts.samples_format,
-                                suffix=""
-                                if shared.opts.data.get(
-                                    "save_ddsd_working_on_dino_mask_images_suffix", ""
+                    cluster_window = shared.opts.data.get(
+                        "ddsd_region_cluster_window", 0
+                    )
+                    if cluster_window > 0:
+                        region_count = len(mask)
+                        mask = region_clusters(
+                            mask, dino_inpaint_padding, cluster_window
+                        )
+                        if len(mask) < region_count:
+                            p.extra_generation_params[
+                                f"DINO {detect_index + 1} Saved Passes"
+                            ] = region_count - len(mask)
+                    for group in region_batches(
+                        pi,
+                        mask,
+                        [
+                            self.target_seeds + mask_index + detect_index
+                            for mask_index in range(len(mask))
+                        ],
+                    ):
+                        for region, region_seed, _ in group:
+                            if shared.opts.data.get(
+                                "save_ddsd_working_on_dino_mask_images", False
+                            ):
+                                images.save_image(
+                                    Image.fromarray(region_unwrap(region)),
+                                    p.outpath_samples,
+                                    shared.opts.data.get(
+                                        "save_ddsd_working_on_dino_mask_images_prefix",
+                                        "",
+                                    ),
+                                    region_seed,
+                                    self.target_prompts,
+                                    opts.samples_format,
+                                    suffix=""
+                                    if shared.opts.data.get(
+                                        "save_ddsd_working_on_dino_mask_images_suffix",
+                                        "",
+                                    )
+                                    == ""
+                                    else f"-{shared.opts.data.get('save_ddsd_working_on_dino_mask_images_suffix', '')}",
+                                    info=create_infotext(
+                                        p,
+                                        p.all_prompts,
+                                        p.all_seeds,
+                                        p.all_subseeds,
+                                        None,
+                                        self.iter_number,
+                                        self.batch_number,
+                                    ),
+                                    p=p,
                                 )
-                                == ""
-                                else f"-{shared.opts.data.get('save_ddsd_working_on_dino_mask_images_suffix', '')}",
-                                info=create_infotext(
-                                    p,
-                                    p.all_prompts,
-                                    p.all_seeds,
-                                    p.all_subseeds,
-                                    None,
-                                    self.iter_number,
-                                    self.batch_number,
-                                ),
-                                p=p,
-                            )
                         state.job_count += 1
-                        processed = processing.process_images(pi)
-                        init_image = processed.images[0]
+                        init_image, processed = region_batch_inpaint(
+                            pi, init_image, group
+                        )
                         if shared.opts.data.get("save_ddsd_working_on_images", False):
                             images.save_image(
                                 init_image,
@@ -1100,7 +1217,7 @@ class Script(modules.scripts.Script):
                                 shared.opts.data.get(
                                     "save_ddsd_working_on_images_prefix", ""
                                 ),
-                                pi.seed,
+                                group[0][1],
                                 self.target_prompts,
                                 opts.samples_format,
                                 suffix=""
@@ -1155,6 +1272,7 @@ class Script(modules.scripts.Script):
                         )
                     state.job_count += 1
                     processed = processing.process_images(pi)
+                    latent_carry_bind(processed)
                     init_image = processed.images[0]
                     if shared.opts.data.get("save_ddsd_working_on_images", False):
                         images.save_image(
@@ -1187,12 +1305,20 @@ class Script(modules.scripts.Script):
                     f"DINO {detect_index + 1}"
                 ] = dino_detection_prompt_list[detect_index]
                 p.extra_generation_params[f"DINO {detect_index + 1} Positive"] = (
-                    processed.all_prompts[0]
+                    (
+                        pi.prompt
+                        if detect_index in regional
+                        else processed.all_prompts[0]
+                    )
                     if dino_detection_positive_list[detect_index]
                     else "original"
                 )
                 p.extra_generation_params[f"DINO {detect_index + 1} Negative"] = (
-                    processed.all_negative_prompts[0]
+                    (
+                        pi.negative_prompt
+                        if detect_index in regional
+                        else processed.all_negative_prompts[0]
+                    )
                     if dino_detection_negative_list[detect_index]
                     else "original"
                 )
@@ -1209,6 +1335,12 @@ class Script(modules.scripts.Script):
                 p.extra_generation_params[
                     f"DINO {detect_index + 1} SplitRemove Area"
                 ] = dino_detection_spliter_remove_area_list[detect_index]
+                p.extra_generation_params[
+                    f"DINO {detect_index + 1} SAM Size"
+                ] = dino_detection_sam_size_list[detect_index]
+                p.extra_generation_params[
+                    f"DINO {detect_index + 1} Peak Masks"
+                ] = expression_peak(dino_detection_prompt_list[detect_index])
                 p.extra_generation_params[f"DINO {detect_index + 1} Ckpt Model"] = (
                     dino_detection_ckpt_list[detect_index]
                     if dino_detection_ckpt_list[detect_index] != "Original"
@@ -1238,6 +1370,12 @@ class Script(modules.scripts.Script):
                 p.extra_generation_params[
                     f"DINO {detect_index + 1} SplitRemove Area"
                 ] = dino_detection_spliter_remove_area_list[detect_index]
+                p.extra_generation_params[
+                    f"DINO {detect_index + 1} SAM Size"
+                ] = dino_detection_sam_size_list[detect_index]
+                p.extra_generation_params[
+                    f"DINO {detect_index + 1} Peak Masks"
+                ] = expression_peak(dino_detection_prompt_list[detect_index])
                 p.extra_generation_params[f"DINO {detect_index + 1} Ckpt Model"] = (
                     dino_detection_ckpt_list[detect_index]
                     if dino_detection_ckpt_list[detect_index] != "Original"
@@ -1248,6 +1386,23 @@ class Script(modules.scripts.Script):
                     if dino_detection_vae_list[detect_index] != "Original"
                     else self.vae
                 )
+        skipped_report = expression_report()
+        if skipped_report > 0:
+            p.extra_generation_params["DINO Skipped Leaves"] = skipped_report
+        if detect_job.reused > 0:
+            p.extra_generation_params["DINO Reused Subtrees"] = detect_job.reused
+        batch_report = region_report()
+        if batch_report is not None:
+            p.extra_generation_params["DINO Region Passes"] = batch_report
+        carry_report = latent_carry_report()
+        if carry_report > 0:
+            p.extra_generation_params["DINO Latent Carry"] = carry_report
+        memo_report = sam_memo_report()
+        if memo_report is not None:
+            p.extra_generation_params["DINO SAM Memo Hit"] = memo_report
+        fast_iou_report = sam_fast_iou_report()
+        if fast_iou_report is not None:
+            p.extra_generation_params["DINO SAM Fast IoU Min/Mean"] = fast_iou_report
         return init_image
 
     def upscale(
@@ -1473,19 +1628,15 @@ class Script(modules.scripts.Script):
                 segmask_preview_a = create_segmask_preview(results_a, init_image)
                 shared.state.current_image = segmask_preview_a
                 gen_count = len(masks_a)
-                state.job_count += gen_count
-
-                pi.seed = self.target_seeds
-                pi.init_images = [init_image]
-
-                for i in range(gen_count):
-                    pi.image_mask = masks_a[i]
-                    processed = processing.process_images(pi)
-                    pi.seed = processed.seed + 1
-                    pi.init_images = processed.images
+                groups = region_batches(
+                    pi,
+                    [region_mask(np.array(mask)) for mask in masks_a],
+                    [self.target_seeds + i for i in range(gen_count)],
+                )
+                state.job_count += len(groups)
 
-                if gen_count > 0:
-                    init_image = processed.images[0]
+                for group in groups:
+                    init_image, processed = region_batch_inpaint(pi, init_image, group)
 
                 p.extra_generation_params[f"YOLO Positive"] = (
                     yolo_detection_positive if yolo_detection_positive else "original"
@@ -1496,6 +1647,12 @@ class Script(modules.scripts.Script):
                 p.extra_generation_params[f"YOLO Denoising"] = pi.denoising_strength
                 p.extra_generation_params[f"YOLO CFG Scale"] = pi.cfg_scale
                 p.extra_generation_params[f"YOLO Steps"] = pi.steps
+                batch_report = region_report()
+                if batch_report is not None:
+                    p.extra_generation_params["YOLO Region Passes"] = batch_report
+                carry_report = latent_carry_report()
+                if carry_report > 0:
+                    p.extra_generation_params["YOLO Latent Carry"] = carry_report
             else:
                 p.extra_generation_params[f"YOLO Positive"] = "Error"
                 p.extra_generation_params[f"YOLO Negative"] = "Error"
@@ -1653,60 +1810,63 @@ class Script(modules.scripts.Script):
         self.dino_detection_spliter_remove_area_list = args_list[
             self.dino_detect_count * 9 : self.dino_detect_count * 10
         ]
+        self.dino_detection_sam_size_list = args_list[
+            self.dino_detect_count * 10 : self.dino_detect_count * 11
+        ]
         self.watermark_count = shared.opts.data.get("watermark_count", 1)
         self.watermark_type_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 0 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 0 : self.dino_detect_count * 11
             + self.watermark_count * 1
         ]
         self.watermark_position_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 1 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 1 : self.dino_detect_count * 11
             + self.watermark_count * 2
         ]
         self.watermark_image_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 2 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 2 : self.dino_detect_count * 11
             + self.watermark_count * 3
         ]
         self.watermark_image_size_width_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 3 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 3 : self.dino_detect_count * 11
             + self.watermark_count * 4
         ]
         self.watermark_image_size_height_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 4 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 4 : self.dino_detect_count * 11
             + self.watermark_count * 5
         ]
         self.watermark_text_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 5 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 5 : self.dino_detect_count * 11
             + self.watermark_count * 6
         ]
         self.watermark_text_color_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 6 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 6 : self.dino_detect_count * 11
             + self.watermark_count * 7
         ]
         self.watermark_text_font_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 7 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 7 : self.dino_detect_count * 11
             + self.watermark_count * 8
         ]
         self.watermark_text_size_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 8 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 8 : self.dino_detect_count * 11
             + self.watermark_count * 9
         ]
         self.watermark_padding_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 9 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 9 : self.dino_detect_count * 11
             + self.watermark_count * 10
         ]
         self.watermark_alpha_list = args_list[
-            self.dino_detect_count * 10
-            + self.watermark_count * 10 : self.dino_detect_count * 10
+            self.dino_detect_count * 11
+            + self.watermark_count * 10 : self.dino_detect_count * 11
             + self.watermark_count * 11
         ]
         self.script_names_list = [
@@ -1749,126 +1909,135 @@ class Script(modules.scripts.Script):
         if getattr(p, "sub_processing", False):
             return
         devices.torch_gc()
-        output_image = pp.image
-        self.target_prompts = p.all_prompts[
-            self.iter_number * p.batch_size : (self.iter_number + 1) * p.batch_size
-        ][self.batch_number]
-        self.target_negative_prompts = p.all_negative_prompts[
-            self.iter_number * p.batch_size : (self.iter_number + 1) * p.batch_size
-        ][self.batch_number]
-        self.target_seeds = p.all_seeds[
-            self.iter_number * p.batch_size : (self.iter_number + 1) * p.batch_size
-        ][self.batch_number]
-        if shared.opts.data.get("save_ddsd_working_on_images", False):
-            images.save_image(
-                output_image,
-                p.outpath_samples,
-                shared.opts.data.get("save_ddsd_working_on_images_prefix", ""),
-                self.target_seeds,
-                self.target_prompts,
-                opts.samples_format,
-                suffix=""
-                if shared.opts.data.get("save_ddsd_working_on_images_suffix", "") == ""
-                else f"-{shared.opts.data.get('save_ddsd_working_on_images_suffix', '')}",
-                info=create_infotext(
-                    p,
-                    p.all_prompts,
-                    p.all_seeds,
-                    p.all_subseeds,
-                    None,
-                    self.iter_number,
-                    self.batch_number,
-                ),
-                p=p,
-            )
-
-        if self.ddetailer_before_upscaler and not self.disable_upscaler:
-            output_image = self.upscale(
-                p,
-                output_image,
-                self.scalevalue,
-                self.upscaler_sample,
-                self.overlap,
-                self.rewidth,
-                self.reheight,
-                self.denoising_strength,
-                self.upscaler_ckpt,
-                self.upscaler_vae,
-                self.detailer_mask_blur,
-                self.dino_full_res_inpaint,
-                self.dino_inpaint_padding,
-            )
-        devices.torch_gc()
+        cond_cache_begin()
+        try:
+            output_image = pp.image
+            self.target_prompts = p.all_prompts[
+                self.iter_number * p.batch_size : (self.iter_number + 1) * p.batch_size
+            ][self.batch_number]
+            self.target_negative_prompts = p.all_negative_prompts[
+                self.iter_number * p.batch_size : (self.iter_number + 1) * p.batch_size
+            ][self.batch_number]
+            self.target_seeds = p.all_seeds[
+                self.iter_number * p.batch_size : (self.iter_number + 1) * p.batch_size
+            ][self.batch_number]
+            if shared.opts.data.get("save_ddsd_working_on_images", False):
+                images.save_image(
+                    output_image,
+                    p.outpath_samples,
+                    shared.opts.data.get("save_ddsd_working_on_images_prefix", ""),
+                    self.target_seeds,
+                    self.target_prompts,
+                    opts.samples_format,
+                    suffix=""
+                    if shared.opts.data.get(
+                        "save_ddsd_working_on_images_suffix", ""
+                    )
+                    == ""
+                    else f"-{shared.opts.data.get('save_ddsd_working_on_images_suffix', '')}",
+                    info=create_infotext(
+                        p,
+                        p.all_prompts,
+                        p.all_seeds,
+                        p.all_subseeds,
+                        None,
+                        self.iter_number,
+                        self.batch_number,
+                    ),
+                    p=p,
+                )
 
-        if not self.disable_detailer:
-            output_image = self.dino_detect_detailer(
-                p,
-                output_image,
-                self.disable_mask_paint_mode,
-                self.inpaint_mask_mode,
-                self.detailer_sample,
-                self.detailer_sam_model,
-                self.detailer_dino_model,
-                self.dino_full_res_inpaint,
-                self.dino_inpaint_padding,
-                self.detailer_mask_blur,
-                self.dino_detect_count,
-                self.dino_detection_ckpt_list,
-                self.dino_detection_vae_list,
-                self.dino_detection_prompt_list,
-                self.dino_detection_positive_list,
-                self.dino_detection_negative_list,
-                self.dino_detection_denoise_list,
-                self.dino_detection_cfg_list,
-                self.dino_detection_steps_list,
-                self.dino_detection_spliter_disable_list,
-                self.dino_detection_spliter_remove_area_list,
-            )
-        devices.torch_gc()
+            if self.ddetailer_before_upscaler and not self.disable_upscaler:
+                output_image = self.upscale(
+                    p,
+                    output_image,
+                    self.scalevalue,
+                    self.upscaler_sample,
+                    self.overlap,
+                    self.rewidth,
+                    self.reheight,
+                    self.denoising_strength,
+                    self.upscaler_ckpt,
+                    self.upscaler_vae,
+                    self.detailer_mask_blur,
+                    self.dino_full_res_inpaint,
+                    self.dino_inpaint_padding,
+                )
+            devices.torch_gc()
 
-        if not self.ddetailer_before_upscaler and not self.disable_upscaler:
-            output_image = self.upscale(
-                p,
-                output_image,
-                self.scalevalue,
-                self.upscaler_sample,
-                self.overlap,
-                self.rewidth,
-                self.reheight,
-                self.denoising_strength,
-                self.upscaler_ckpt,
-                self.upscaler_vae,
-                self.detailer_mask_blur,
-                self.dino_full_res_inpaint,
-                self.dino_inpaint_padding,
-            )
-        devices.torch_gc()
+            if not self.disable_detailer:
+                output_image = self.dino_detect_detailer(
+                    p,
+                    output_image,
+                    self.disable_mask_paint_mode,
+                    self.inpaint_mask_mode,
+                    self.detailer_sample,
+                    self.detailer_sam_model,
+                    self.detailer_dino_model,
+                    self.dino_full_res_inpaint,
+                    self.dino_inpaint_padding,
+                    self.detailer_mask_blur,
+                    self.dino_detect_count,
+                    self.dino_detection_ckpt_list,
+                    self.dino_detection_vae_list,
+                    self.dino_detection_prompt_list,
+                    self.dino_detection_positive_list,
+                    self.dino_detection_negative_list,
+                    self.dino_detection_denoise_list,
+                    self.dino_detection_cfg_list,
+                    self.dino_detection_steps_list,
+                    self.dino_detection_spliter_disable_list,
+                    self.dino_detection_spliter_remove_area_list,
+                    self.dino_detection_sam_size_list,
+                )
+            devices.torch_gc()
 
-        if not self.disable_yoloddetailer:
-            output_image = self.yolo_detect_detailer(
-                p,
-                output_image,
-                self.dd_model_a,
-                self.dd_conf_a,
-                self.dd_dilation_factor_a,
-                self.dd_offset_x_a,
-                self.dd_offset_y_a,
-                self.dd_mask_blur,
-                self.dd_denoising_strength,
-                self.dd_inpaint_full_res,
-                self.dd_inpaint_full_res_padding,
-                self.b_dd_yolo_cfg,
-                self.b_dd_yolo_step,
-                self.dd_yolo_cfg,
-                self.dd_yolo_step,
-                self.yolo_detection_positive,
-                self.yolo_detection_negative,
-            )
+            if not self.ddetailer_before_upscaler and not self.disable_upscaler:
+                output_image = self.upscale(
+                    p,
+                    output_image,
+                    self.scalevalue,
+                    self.upscaler_sample,
+                    self.overlap,
+                    self.rewidth,
+                    self.reheight,
+                    self.denoising_strength,
+                    self.upscaler_ckpt,
+                    self.upscaler_vae,
+                    self.detailer_mask_blur,
+                    self.dino_full_res_inpaint,
+                    self.dino_inpaint_padding,
+                )
+            devices.torch_gc()
 
-        devices.torch_gc()
-        if not self.disable_watermark:
-            output_image = self.watermark(p, output_image)
+            if not self.disable_yoloddetailer:
+                output_image = self.yolo_detect_detailer(
+                    p,
+                    output_image,
+                    self.dd_model_a,
+                    self.dd_conf_a,
+                    self.dd_dilation_factor_a,
+                    self.dd_offset_x_a,
+                    self.dd_offset_y_a,
+                    self.dd_mask_blur,
+                    self.dd_denoising_strength,
+                    self.dd_inpaint_full_res,
+                    self.dd_inpaint_full_res_padding,
+                    self.b_dd_yolo_cfg,
+                    self.b_dd_yolo_step,
+                    self.dd_yolo_cfg,
+                    self.dd_yolo_step,
+                    self.yolo_detection_positive,
+                    self.yolo_detection_negative,
+                )
 
+            devices.torch_gc()
+            if not self.disable_watermark:
+                output_image = self.watermark(p, output_image)
+        finally:
+            cond_report = cond_cache_end()
+        if cond_report > 0:
+            p.extra_generation_params["DDSD Cond Cache Hit"] = cond_report
         devices.torch_gc()
         self.batch_number += 1
         self.restore_script(p)
@@ -1948,7 +2117,190 @@ def on_ui_settings():
             section=section,
         ),
     )
+    shared.opts.add_option(
+        "ddsd_sam_crop_windows",
+        shared.OptionInfo(
+            False,
+            "Run SAM on cropped windows around detected boxes",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_sam_crop_padding",
+        shared.OptionInfo(
+            25,
+            "SAM cropped window padding(% of box size)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 100, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_sam_crop_batch",
+        shared.OptionInfo(
+            4,
+            "SAM cropped window encoder batch size",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "ddsd_sam_decode_chunk",
+        shared.OptionInfo(
+            16,
+            "SAM mask decoder box chunk size",
+            gr.Slider,
+            {"minimum": 1, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
 
+    shared.opts.add_option(
+        "ddsd_sam_memo",
+        shared.OptionInfo(
+            False,
+            "Reuse SAM masks for nearly identical boxes on unchanged regions",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_sam_memo_iou",
+        shared.OptionInfo(
+            0.9,
+            "SAM mask memo box IoU tolerance",
+            gr.Slider,
+            {"minimum": 0.5, "maximum": 1.0, "step": 0.01},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_sam_memo_size",
+        shared.OptionInfo(
+            64,
+            "SAM mask memo max boxes",
+            gr.Slider,
+            {"minimum": 1, "maximum": 512, "step": 1},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "ddsd_sam_fast_compare",
+        shared.OptionInfo(
+            False,
+            "Compare reduced SAM encoder size masks against full size (mask IoU)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+
+    shared.opts.add_option(
+        "ddsd_mask_format",
+        shared.OptionInfo(
+            "Dense",
+            "Detect mask format (Packed keeps 1 bit per pixel and binarizes soft FILE and paint masks at 50%, Region keeps the bounding box crop, Torch keeps masks on the inference device, until the inpaint mask is built)",
+            gr.Radio,
+            {"choices": ["Packed", "Region", "Torch", "Dense"]},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_mask_scale",
+        shared.OptionInfo(
+            1.0,
+            "Detect mask working scale (expression, dilation and splitting run at this scale, upsampled once with a guided filter)",
+            gr.Slider,
+            {"minimum": 0.25, "maximum": 1.0, "step": 0.05},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_dilation_shape",
+        shared.OptionInfo(
+            "Square",
+            "Dilation shape for detect and yolo masks",
+            gr.Radio,
+            {"choices": ["Square", "Disk"]},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_leaf_workers",
+        shared.OptionInfo(
+            0,
+            "Detect leaf worker threads (0 evaluates leaves one by one, DINO/SAM inference stays serialized)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 8, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_mask_embed_cache",
+        shared.OptionInfo(
+            16,
+            "Decoded FILE mask cache size",
+            gr.Slider,
+            {"minimum": 1, "maximum": 128, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_region_batch_size",
+        shared.OptionInfo(
+            4,
+            "Split regions inpainted per sampler call (1 inpaints them one by one)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_region_cluster_window",
+        shared.OptionInfo(
+            0,
+            "Merge split regions into shared inpaint windows up to this size (0 disables)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 2048, "step": 32},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_latent_carry",
+        shared.OptionInfo(
+            False,
+            "Start whole picture inpaint passes from the previous pass latent (same checkpoint and VAE)",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_regional_prompting",
+        shared.OptionInfo(
+            False,
+            "Inpaint consecutive detect passes that only differ in positive prompt in one regional prompt run",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "ddsd_cond_cache",
+        shared.OptionInfo(
+            True,
+            "Reuse prompt conditioning across detailer passes and upscale tiles",
+            gr.Checkbox,
+            {"interactive": True},
+            section=section,
+        ),
+    )
     shared.opts.add_option(
         "save_ddsd_watermark_with_and_without",
         shared.OptionInfo(
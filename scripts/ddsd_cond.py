@@ -0,0 +1,64 @@
+import sys
+from modules import prompt_parser, shared
+
+# Text encoder results of the sub passes of one ddsd job (detailers, upscale
+# tiles), processing looks the parser functions up on the module at call time.
+cond_cache = {}
+cond_original = {}
+cond_stats = {'hits':0}
+cond_functions = ['get_learned_conditioning', 'get_multicond_learned_conditioning']
+
+# Loaded extra networks change the text encoder weights without showing up in
+# the prompts left after the tags are stripped. webui 1.5+ keeps them in
+# networks.loaded_networks, older versions in lora.loaded_loras.
+def cond_cache_networks():
+    networks, lora = sys.modules.get('networks'), sys.modules.get('lora')
+    if networks is None and lora is None: return None
+    return (
+        tuple((network.name, getattr(network, 'te_multiplier', None)) for network in getattr(networks, 'loaded_networks', [])),
+        tuple((network.name, getattr(network, 'multiplier', None)) for network in getattr(lora, 'loaded_loras', []))
+    )
+
+def cond_cache_key(name, model, prompts, steps, args, kwargs):
+    return (
+        name,
+        tuple(prompts),
+        steps,
+        args,
+        tuple(sorted(kwargs.items())),
+        getattr(prompts, 'is_negative_prompt', None),
+        getattr(prompts, 'width', None),
+        getattr(prompts, 'height', None),
+        getattr(model, 'sd_model_hash', None),
+        shared.opts.data.get('CLIP_stop_at_last_layers', 1),
+        cond_cache_networks()
+    )
+
+def cond_cached(name, function):
+    def cached(model, prompts, steps, *args, **kwargs):
+        key = cond_cache_key(name, model, prompts, steps, args, kwargs)
+        if key in cond_cache:
+            cond_stats['hits'] += 1
+            return cond_cache[key]
+        cond_cache[key] = function(model, prompts, steps, *args, **kwargs)
+        return cond_cache[key]
+    return cached
+
+def cond_cache_begin():
+    cond_cache_end()
+    if not shared.opts.data.get('ddsd_cond_cache', True): return
+    if cond_cache_networks() is None:
+        print('Conditioning cache off, no extra network module to key the cache on')
+        return
+    for name in cond_functions:
+        cond_original[name] = getattr(prompt_parser, name)
+        setattr(prompt_parser, name, cond_cached(name, cond_original[name]))
+
+def cond_cache_end():
+    for name, function in cond_original.items():
+        setattr(prompt_parser, name, function)
+    cond_original.clear()
+    cond_cache.clear()
+    report = cond_stats['hits']
+    cond_stats['hits'] = 0
+    return report
@@ -90,6 +90,8 @@ def get_grounding_output(model, image, caption, box_threshold):
     filt_mask = logits_filt.max(dim=1)[0] > box_threshold
     logits_filt = logits_filt[filt_mask]  # num_filt, 256
     boxes_filt = boxes_filt[filt_mask]  # num_filt, 4
+    # best scored box first, TOPK n:SCORE keeps the first n
+    boxes_filt = boxes_filt[logits_filt.max(dim=1)[0].argsort(descending=True)]
 
     return boxes_filt.cpu()
 
@@ -0,0 +1,347 @@
+import re
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+
+token_split = re.compile(r"(\(|\)|AND|OR|NOR|XOR|NAND|TOPK\s*[\d]*(?::\s*(?:SCORE|AREA))?|LARGEST|MINAREA\s*[\d.]*\s*%?|MAXREGIONS\s*[\d]*)")
+token_file = re.compile(r'\s*<(.*)>\s*')
+token_selector = re.compile(r'(TOPK|LARGEST|MINAREA|MAXREGIONS)\s*([\d.]*)\s*%?(?::\s*(SCORE|AREA))?$')
+token_operators = ['AND', 'OR', 'NOR', 'XOR', 'NAND']
+mask_modes = ['SAM', 'RECT', 'ELLIPSE', 'ROUND']
+file_usages = {'AREA': ['LEFT', 'RIGHT', 'TOP', 'BOTTOM', 'ALL'], 'FILE': None}
+
+# kind is DINO, FILE, OP or SELECT. args are indices of the child nodes in
+# ExprPlan.nodes, const nodes only depend on the image size and are folded
+# without any model. SELECT keeps some connected regions of its operand, its
+# value is ('TOPK', n) for the n largest regions or ('MINAREA', percent).
+ExprNode = namedtuple('ExprNode', ['kind', 'key', 'value', 'args', 'const'])
+# nodes are in postfix order with the root last, steps are the nodes the evaluator
+# has to visit once the constant subtrees are folded. The subtree of a node spans
+# nodes[starts[index]:index + 1], heads maps a step to the non constant subtrees
+# whose evaluation begins there, largest first. max_regions caps the inpaint
+# passes the splitter makes from the result, 0 is no cap.
+ExprPlan = namedtuple('ExprPlan', ['prompt', 'nodes', 'steps', 'parents', 'starts', 'heads', 'max_regions'])
+# Mask callbacks used by evaluate_plan, supplied by the caller that owns the models.
+# prefetch is optional, it gets the leaves that are evaluated whatever the masks
+# turn out to be so they can start before evaluate_plan asks for them.
+ExprBackend = namedtuple('ExprBackend', ['format', 'leaf', 'const', 'combine', 'empty', 'is_empty', 'is_full', 'boxes_intersect', 'select', 'prefetch'], defaults=[None])
+
+expression_cache = OrderedDict()
+expression_const_cache = OrderedDict()
+expression_stats = {'skipped': 0, 'peak': {}}
+
+def try_convert(data, type, default, min, max):
+    try:
+        convert = type(data)
+        if convert < min: return min
+        if convert > max: return max
+        return convert
+    except (ValueError, TypeError):
+        return default
+
+def prompt_spliter(prompt:str, split_token:str, count:int):
+    spliter = prompt.split(split_token)
+    while len(spliter) < count:
+        spliter.append('')
+    return spliter[:count]
+
+def parse_leaf(prompt:str, text:str):
+    match = token_file.match(text)
+    if match is not None:
+        usage_type, usage, dilation = prompt_spliter(match.group(1), ':', 3)
+        usage_type, usage = usage_type.strip().upper(), usage.strip().upper()
+        if usage_type not in file_usages:
+            raise RuntimeError(f'Unknown mask token "<{match.group(1)}>" in "{prompt}"')
+        if file_usages[usage_type] is not None and usage not in file_usages[usage_type]:
+            raise RuntimeError(f'Unknown {usage_type} "{usage}" in "{prompt}", use one of {file_usages[usage_type]}')
+        value = (usage_type, usage, try_convert(dilation.strip(), int, 2, 0, 512))
+        return 'FILE', f'<{value[0]}:{value[1]}:{value[2]}>', value
+    dino_text, sam_level, dino_box_threshold, dilation, mask_mode = prompt_spliter(text, ':', 5)
+    dino_text, mask_mode = dino_text.strip(), mask_mode.strip().upper()
+    if not dino_text:
+        raise RuntimeError(f'Please input dino text, empty detect token in "{prompt}"')
+    value = (
+        dino_text,
+        try_convert(sam_level.strip(), int, 0, 0, 2),
+        try_convert(dino_box_threshold.strip(), float, 0.3, 0, 1.0),
+        try_convert(dilation.strip(), int, 16, 0, 512),
+        mask_mode if mask_mode in mask_modes else 'SAM',
+        0
+    )
+    return 'DINO', dino_key(value), value
+
+# The last value of a dino token keeps only the n best scored boxes, 0 keeps all.
+def dino_key(value):
+    key = ':'.join(str(x) for x in value[:5])
+    return f'{key} TOPK {value[5]}:SCORE' if value[5] > 0 else key
+
+# Sethi-Ullman numbering, every operator is commutative so the child that needs
+# more live masks is evaluated first and only its result is held while the other
+# child runs. Constant subtrees fold into a single mask and keep their order.
+# The left child of AND/NAND/OR/NOR can short circuit the right one, so those
+# only swap when the right child has no more dino leaves than the left.
+def order_nodes(nodes, root):
+    need, cost = {}, {}
+    for index, node in enumerate(nodes):
+        cost[index] = sum(cost[x] for x in node.args) + (node.kind == 'DINO')
+        if node.const or not node.args:
+            need[index] = 1
+            continue
+        if len(node.args) == 1:
+            need[index] = need[node.args[0]]
+            continue
+        left, right = need[node.args[0]], need[node.args[1]]
+        need[index] = max(left, right) if left != right else left + 1
+    ordered = []
+
+    def emit(index):
+        node = nodes[index]
+        args = node.args
+        if not node.const and len(args) == 2 and need[args[1]] > need[args[0]] and (node.value == 'XOR' or cost[args[1]] <= cost[args[0]]):
+            args = (args[1], args[0])
+        args = tuple(emit(x) for x in args)
+        ordered.append(node._replace(args=args))
+        return len(ordered) - 1
+
+    emit(root)
+    return ordered
+
+def compile_expression(prompt:str):
+    if prompt in expression_cache:
+        expression_cache.move_to_end(prompt)
+        return expression_cache[prompt]
+    tokens = [x for x in token_split.split(prompt) if x.strip()]
+    nodes = []
+
+    def add_node(kind, key, value, args):
+        nodes.append(ExprNode(kind, key, value, tuple(args), kind == 'FILE' or (kind != 'DINO' and all(nodes[x].const for x in args))))
+        return len(nodes) - 1
+
+    def add_selector(index, token):
+        name, number, by = token_selector.match(token).groups()
+        if name == 'MAXREGIONS':
+            raise RuntimeError(f'MAXREGIONS has to be at the end of "{prompt}"')
+        if name == 'MINAREA':
+            percent = try_convert(number, float, 1.0, 0, 100)
+            return add_node('SELECT', f'{nodes[index].key} MINAREA {percent}%', ('MINAREA', percent), [index])
+        count = 1 if name == 'LARGEST' else try_convert(number, int, 1, 1, 1000)
+        if by != 'SCORE':
+            return add_node('SELECT', f'{nodes[index].key} TOPK {count}', ('TOPK', count), [index])
+        if nodes[index].kind != 'DINO':
+            raise RuntimeError(f'TOPK {count}:SCORE needs a dino token in "{prompt}"')
+        value = nodes[index].value
+        value = value[:5] + (min(count, value[5]) if value[5] > 0 else count,)
+        nodes[index] = nodes[index]._replace(key=dino_key(value), value=value)
+        return index
+
+    def parse_selectors(index, position):
+        while position < len(tokens) and token_selector.match(tokens[position]):
+            if tokens[position].startswith('MAXREGIONS') and position == len(tokens) - 1: break
+            index, position = add_selector(index, tokens[position]), position + 1
+        return index, position
+
+    def parse_operand(position):
+        if position >= len(tokens):
+            raise RuntimeError(f'Missing detect token at the end of "{prompt}"')
+        token = tokens[position]
+        if token == '(':
+            index, position = parse_expression(position + 1)
+            if position >= len(tokens) or tokens[position] != ')':
+                raise RuntimeError(f'Unbalanced parentheses in "{prompt}"')
+            return parse_selectors(index, position + 1)
+        if token == ')' or token in token_operators or token_selector.match(token):
+            raise RuntimeError(f'Unexpected "{token}" in "{prompt}"')
+        return parse_selectors(add_node(*parse_leaf(prompt, token), []), position + 1)
+
+    def parse_expression(position):
+        left, position = parse_operand(position)
+        while position < len(tokens) and tokens[position] in token_operators:
+            operator = tokens[position]
+            right, position = parse_operand(position + 1)
+            key = f' {operator} '.join(sorted([nodes[left].key, nodes[right].key]))
+            left = add_node('OP', f'({key})', operator, [left, right])
+        return left, position
+
+    root, position = parse_expression(0)
+    max_regions = 0
+    if position < len(tokens) and tokens[position].startswith('MAXREGIONS'):
+        max_regions = try_convert(token_selector.match(tokens[position]).group(2), int, 1, 1, 1000)
+        position += 1
+    if position < len(tokens):
+        raise RuntimeError(f'Unexpected "{tokens[position]}" in "{prompt}"')
+    nodes, root = order_nodes(nodes, root), len(nodes) - 1
+    parents = {x: index for index, node in enumerate(nodes) for x in node.args}
+    starts = list(range(len(nodes)))
+    for index, node in enumerate(nodes):
+        if node.args: starts[index] = starts[node.args[0]]
+    steps = [index for index, node in enumerate(nodes) if not node.const or index == root or not nodes[parents[index]].const]
+    heads = {}
+    for index, node in enumerate(nodes):
+        if not node.const: heads.setdefault(steps[bisect_left(steps, starts[index])], []).append(index)
+    for head in heads.values(): head.sort(reverse=True)
+    plan = ExprPlan(prompt, nodes, steps, parents, starts, heads, max_regions)
+    expression_cache[prompt] = plan
+    while len(expression_cache) > 64:
+        expression_cache.popitem(last=False)
+    return plan
+
+# Common subexpressions of all the expressions of a detect job. Results are kept
+# only while the same subtree is still used later in the job, and only for the
+# current image, the cache is dropped whenever the job moves to another image.
+class ExprJob:
+    def __init__(self, plans):
+        self.image = None
+        self.scope = None
+        self.version = 0
+        self.cache = {}
+        self.boxes = {}
+        self.uses = {}
+        self.reused = 0
+        for plan in plans:
+            for node in plan.nodes:
+                if not node.const: self.uses[node.key] = self.uses.get(node.key, 0) + 1
+
+    def update(self, image, scope):
+        self.scope = scope
+        if image is self.image: return
+        self.image = image
+        self.version += 1
+        self.cache.clear()
+        self.boxes.clear()
+
+    def lookup(self, key):
+        cache_key = (self.scope, self.version, key)
+        if cache_key not in self.cache: return None
+        self.uses[key] -= 1
+        self.reused += 1
+        return self.cache[cache_key] if self.uses[key] > 0 else self.cache.pop(cache_key)
+
+    def store(self, key, result):
+        self.uses[key] = self.uses.get(key, 1) - 1
+        if self.uses[key] > 0: self.cache[(self.scope, self.version, key)] = result
+
+    def release(self, key):
+        self.uses[key] -= 1
+        if self.uses[key] <= 0: self.cache.pop((self.scope, self.version, key), None)
+
+    def holds(self, result):
+        return any(result is x for x in self.cache.values())
+
+def fold_constant(plan, index, shape, backend):
+    node = plan.nodes[index]
+    cache_key = (backend.format, node.key, shape)
+    if cache_key in expression_const_cache:
+        expression_const_cache.move_to_end(cache_key)
+        return expression_const_cache[cache_key]
+    if node.kind == 'FILE':
+        mask = backend.const(node.value, shape)
+    elif node.kind == 'SELECT':
+        mask = backend.select(fold_constant(plan, node.args[0], shape, backend), node.value)
+    else:
+        mask = backend.combine(fold_constant(plan, node.args[0], shape, backend), node.value, fold_constant(plan, node.args[1], shape, backend))
+    expression_const_cache[cache_key] = mask
+    while len(expression_const_cache) > 16:
+        expression_const_cache.popitem(last=False)
+    return mask
+
+def count_leaves(plan, index):
+    return sum(1 for node in plan.nodes[plan.starts[index]:index + 1] if node.kind == 'DINO')
+
+def short_circuit(plan, index, result, backend):
+    parent = plan.parents.get(index)
+    if parent is None or plan.nodes[parent].args[0] != index or plan.nodes[parent].const: return None
+    operator = plan.nodes[parent].value
+    if operator in ['AND', 'NAND'] and backend.is_empty(result): return parent
+    if operator in ['OR', 'NOR'] and backend.is_full(result): return parent
+    return None
+
+def prune_candidate(plan, index, parent):
+    node = plan.nodes[parent]
+    return node.args[0] == index and node.value in ['AND', 'NAND'] and plan.nodes[node.args[1]].kind == 'DINO'
+
+def prune_boxes(plan, index, backend):
+    parent = plan.parents.get(index)
+    if parent is None or not prune_candidate(plan, index, parent): return None
+    right = plan.nodes[plan.nodes[parent].args[1]]
+    if backend.boxes_intersect(plan.nodes[index].value, right.value): return None
+    return parent
+
+# DINO leaves that neither short circuit nor box pruning can skip.
+def certain_leaves(plan):
+    leaves = []
+    for index, node in enumerate(plan.nodes):
+        if node.kind != 'DINO': continue
+        parent = plan.parents.get(index)
+        if parent is not None and prune_candidate(plan, index, parent): continue
+        child = index
+        while parent is not None:
+            if plan.nodes[parent].kind == 'OP' and plan.nodes[parent].value != 'XOR' and plan.nodes[parent].args[1] == child: break
+            child, parent = parent, plan.parents.get(parent)
+        if parent is None: leaves.append(index)
+    return leaves
+
+def evaluate_plan(plan, shape, backend, job=None):
+    results = {}
+    peak = 0
+    if backend.prefetch is not None:
+        backend.prefetch([plan.nodes[x].value for x in certain_leaves(plan) if job is None or (job.scope, job.version, plan.nodes[x].key) not in job.cache])
+    skip_until = -1
+    for index in plan.steps:
+        if index <= skip_until: continue
+        node = plan.nodes[index]
+        result = None
+        if job is not None:
+            for head in plan.heads.get(index, []):
+                result = job.lookup(plan.nodes[head].key)
+                if result is not None:
+                    print(f'Reuse {plan.nodes[head].key}')
+                    for inner in plan.nodes[plan.starts[head]:head]:
+                        if not inner.const: job.release(inner.key)
+                    index, skip_until = head, head
+                    break
+        if result is not None:
+            pass
+        elif node.const:
+            result = fold_constant(plan, index, shape, backend)
+        elif node.kind == 'DINO':
+            parent = prune_boxes(plan, index, backend)
+            if parent is not None:
+                print(f'Skip {plan.nodes[parent].key}, dino boxes do not intersect')
+                expression_stats['skipped'] += 2
+                empty = backend.empty(shape)
+                result, index, skip_until = backend.combine(empty, plan.nodes[parent].value, empty), parent, parent
+                if job is not None:
+                    job.release(node.key)
+                    job.release(plan.nodes[plan.nodes[parent].args[1]].key)
+            else:
+                result = backend.leaf(node.value)
+            if job is not None: job.store(plan.nodes[index].key, result)
+        elif node.kind == 'SELECT':
+            result = backend.select(results.pop(node.args[0]), node.value)
+            if job is not None: job.store(node.key, result)
+        else:
+            result = backend.combine(results.pop(node.args[0]), node.value, results.pop(node.args[1]))
+            if job is not None: job.store(node.key, result)
+        parent = short_circuit(plan, index, result, backend)
+        while parent is not None:
+            right = plan.nodes[parent].args[1]
+            print(f'Skip {plan.nodes[right].key}, {plan.nodes[parent].value} is decided')
+            expression_stats['skipped'] += count_leaves(plan, right)
+            if job is not None:
+                for inner in plan.nodes[plan.starts[right]:right + 1]:
+                    if not inner.const: job.release(inner.key)
+            result, index, skip_until = backend.combine(result, plan.nodes[parent].value, result), parent, parent
+            if job is not None: job.store(plan.nodes[index].key, result)
+            parent = short_circuit(plan, index, result, backend)
+        results[index] = result
+        peak = max(peak, len(results))
+    expression_stats['peak'][plan.prompt] = peak
+    result = results[len(plan.nodes) - 1]
+    return result.copy() if plan.nodes[-1].const or (job is not None and job.holds(result)) else result
+
+def expression_peak(prompt:str):
+    return expression_stats['peak'].pop(prompt, 0)
+
+def expression_report():
+    report = expression_stats['skipped']
+    expression_stats['skipped'] = 0
+    return report
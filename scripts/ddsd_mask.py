@@ -0,0 +1,196 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from collections import namedtuple
+from modules.devices import device
+
+# Mask formats for the detect expression evaluator. wrap takes the dense uint8
+# 0/255 masks made by SAM and the file tokens, unwrap gives them back where the
+# inpaint mask is built, everything in between stays in the format.
+MaskFormat = namedtuple('MaskFormat', ['name', 'wrap', 'unwrap', 'combine', 'empty', 'is_empty', 'is_full'])
+
+# 1 bit per pixel, rows are flattened and packed big endian. Padding bits of the
+# last byte are always kept zero. Soft masks are thresholded at 127 on wrap.
+class PackedMask(namedtuple('PackedMask', ['bits', 'shape'])):
+    def copy(self):
+        return PackedMask(self.bits.copy(), self.shape)
+
+# Tight bounding box (y0, x0, y1, x1) and the crop inside it, the rest of the
+# frame is zero. An empty mask has an empty box.
+class RegionMask(namedtuple('RegionMask', ['box', 'crop', 'shape'])):
+    def copy(self):
+        return RegionMask(self.box, self.crop.copy(), self.shape)
+
+# uint8 0/255 tensor on the inference device, on cpu wrap and unwrap share the
+# numpy memory.
+class TorchMask(namedtuple('TorchMask', ['tensor'])):
+    def copy(self):
+        return TorchMask(self.tensor.clone())
+
+def combine_masks(mask, combine_masks_option, mask2):
+    if combine_masks_option == 'AND': return cv2.bitwise_and(mask, mask2)
+    if combine_masks_option == 'OR': return cv2.bitwise_or(mask, mask2)
+    if combine_masks_option == 'XOR': return cv2.bitwise_xor(mask, mask2)
+    if combine_masks_option == 'NOR': return cv2.bitwise_not(cv2.bitwise_or(mask, mask2))
+    if combine_masks_option == 'NAND': return cv2.bitwise_not(cv2.bitwise_and(mask,mask2))
+
+def packed_tail(shape):
+    return (0xFF << (-(shape[0] * shape[1]) % 8)) & 0xFF
+
+def pack_mask(mask):
+    return PackedMask(np.packbits(mask.reshape(-1) > 127), mask.shape[:2])
+
+def unpack_mask(mask):
+    return np.unpackbits(mask.bits, count=mask.shape[0] * mask.shape[1]).reshape(mask.shape) * np.uint8(255)
+
+def packed_empty(shape):
+    return PackedMask(np.zeros((shape[0] * shape[1] + 7) // 8, dtype=np.uint8), tuple(shape[:2]))
+
+def packed_combine(mask, combine_masks_option, mask2):
+    if combine_masks_option == 'AND': return PackedMask(np.bitwise_and(mask.bits, mask2.bits), mask.shape)
+    if combine_masks_option == 'OR': return PackedMask(np.bitwise_or(mask.bits, mask2.bits), mask.shape)
+    if combine_masks_option == 'XOR': return PackedMask(np.bitwise_xor(mask.bits, mask2.bits), mask.shape)
+    if combine_masks_option == 'NOR': bits = np.bitwise_or(mask.bits, mask2.bits)
+    if combine_masks_option == 'NAND': bits = np.bitwise_and(mask.bits, mask2.bits)
+    np.invert(bits, out=bits)
+    if bits.size > 0: bits[-1] &= packed_tail(mask.shape)
+    return PackedMask(bits, mask.shape)
+
+def packed_is_empty(mask):
+    return not mask.bits.any()
+
+def packed_is_full(mask):
+    if mask.bits.size < 1: return True
+    return bool((mask.bits[:-1] == 0xFF).all()) and mask.bits[-1] == packed_tail(mask.shape)
+
+def region_box(mask):
+    x, y, w, h = cv2.boundingRect(mask)
+    return (y, x, y + h, x + w)
+
+def region_mask(mask, offset=(0, 0), shape=None):
+    y0, x0, y1, x1 = region_box(mask)
+    if y1 <= y0: return region_empty(shape or mask.shape)
+    box = (y0 + offset[0], x0 + offset[1], y1 + offset[0], x1 + offset[1])
+    return RegionMask(box, np.ascontiguousarray(mask[y0:y1, x0:x1]), tuple((shape or mask.shape)[:2]))
+
+def region_unwrap(mask):
+    result = np.zeros(mask.shape, dtype=np.uint8)
+    y0, x0, y1, x1 = mask.box
+    result[y0:y1, x0:x1] = mask.crop
+    return result
+
+def region_empty(shape):
+    return RegionMask((0, 0, 0, 0), np.zeros((0, 0), dtype=np.uint8), tuple(shape[:2]))
+
+def region_paste(mask, box):
+    result = np.zeros((box[2] - box[0], box[3] - box[1]), dtype=np.uint8)
+    y0, x0 = max(mask.box[0], box[0]), max(mask.box[1], box[1])
+    y1, x1 = min(mask.box[2], box[2]), min(mask.box[3], box[3])
+    if y1 > y0 and x1 > x0:
+        result[y0 - box[0]:y1 - box[0], x0 - box[1]:x1 - box[1]] = mask.crop[y0 - mask.box[0]:y1 - mask.box[0], x0 - mask.box[1]:x1 - mask.box[1]]
+    return result
+
+def region_combine(mask, combine_masks_option, mask2):
+    if combine_masks_option == 'AND':
+        box = (max(mask.box[0], mask2.box[0]), max(mask.box[1], mask2.box[1]), min(mask.box[2], mask2.box[2]), min(mask.box[3], mask2.box[3]))
+        if box[2] <= box[0] or box[3] <= box[1]: return region_empty(mask.shape)
+    elif combine_masks_option in ['OR', 'XOR']:
+        if mask.box[2] <= mask.box[0]: return mask2
+        if mask2.box[2] <= mask2.box[0]: return mask
+        box = (min(mask.box[0], mask2.box[0]), min(mask.box[1], mask2.box[1]), max(mask.box[2], mask2.box[2]), max(mask.box[3], mask2.box[3]))
+    else:
+        box = (0, 0, mask.shape[0], mask.shape[1])
+    crop = combine_masks(region_paste(mask, box), combine_masks_option, region_paste(mask2, box))
+    return region_mask(crop, box[:2], mask.shape)
+
+def region_is_full(mask):
+    return mask.box == (0, 0, mask.shape[0], mask.shape[1]) and cv2.countNonZero(mask.crop) == mask.crop.size
+
+# SELECT of the detect expression on a dense mask, ('TOPK', n) keeps the n
+# largest connected regions, ('MINAREA', percent) the ones covering at least
+# percent of the frame.
+def select_regions(mask, value):
+    count, labels, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    if value[0] == 'TOPK':
+        keep = np.argsort(-areas, kind='stable')[:value[1]] + 1
+    else:
+        keep = np.flatnonzero(areas * 100 >= value[1] * mask.shape[0] * mask.shape[1]) + 1
+    if len(keep) == count - 1: return mask
+    lookup = np.zeros(count, dtype=np.uint8)
+    lookup[keep] = 255
+    return np.minimum(lookup[labels], mask)
+
+def mask_work_shape(shape, scale):
+    return (max(1, round(shape[0] * scale)), max(1, round(shape[1] * scale)))
+
+def mask_downscale(mask, shape):
+    if mask.shape[:2] == tuple(shape): return mask
+    mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+    return cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
+
+def tensor_downscale(mask, shape):
+    if tuple(mask.shape[:2]) == tuple(shape): return mask
+    with torch.no_grad():
+        mask = F.interpolate(mask[None, None].float(), size=tuple(shape), mode='area')[0, 0]
+        return (mask > 127).to(torch.uint8).mul_(255)
+
+# Guided filter (He et al.) with the grayscale image as guide, so the upsampled
+# mask edge snaps to image edges. Only the bounding box of the mask is filtered.
+def guided_upsample(mask, guide, radius, eps=1e-3):
+    h, w = guide.shape[:2]
+    scale_y, scale_x = h / mask.shape[0], w / mask.shape[1]
+    x, y, bw, bh = cv2.boundingRect(mask)
+    result = np.zeros((h, w), dtype=np.uint8)
+    if bw < 1: return result
+    y0, x0 = max(int(y * scale_y) - radius * 2, 0), max(int(x * scale_x) - radius * 2, 0)
+    y1, x1 = min(int((y + bh) * scale_y) + radius * 2, h), min(int((x + bw) * scale_x) + radius * 2, w)
+    p = cv2.resize(mask, (w, h), interpolation=cv2.INTER_LINEAR)[y0:y1, x0:x1].astype(np.float32) / 255
+    i = guide[y0:y1, x0:x1].astype(np.float32) / 255
+    size = (radius * 2 + 1, radius * 2 + 1)
+    mean_i = cv2.boxFilter(i, -1, size)
+    mean_p = cv2.boxFilter(p, -1, size)
+    var_i = cv2.boxFilter(i * i, -1, size) - mean_i * mean_i
+    a = (cv2.boxFilter(i * p, -1, size) - mean_i * mean_p) / (var_i + eps)
+    b = mean_p - a * mean_i
+    q = cv2.boxFilter(a, -1, size) * i + cv2.boxFilter(b, -1, size)
+    result[y0:y1, x0:x1][q > 0.5] = 255
+    return result
+
+def torch_wrap(mask):
+    if isinstance(mask, np.ndarray): mask = torch.from_numpy(np.ascontiguousarray(mask))
+    return TorchMask(mask.to(device))
+
+def torch_combine(mask, combine_masks_option, mask2):
+    if combine_masks_option == 'AND': return TorchMask(torch.bitwise_and(mask.tensor, mask2.tensor))
+    if combine_masks_option == 'OR': return TorchMask(torch.bitwise_or(mask.tensor, mask2.tensor))
+    if combine_masks_option == 'XOR': return TorchMask(torch.bitwise_xor(mask.tensor, mask2.tensor))
+    if combine_masks_option == 'NOR': return TorchMask(torch.bitwise_or(mask.tensor, mask2.tensor).bitwise_not_())
+    if combine_masks_option == 'NAND': return TorchMask(torch.bitwise_and(mask.tensor, mask2.tensor).bitwise_not_())
+
+mask_formats = {
+    'Packed': MaskFormat('Packed', pack_mask, unpack_mask, packed_combine, packed_empty, packed_is_empty, packed_is_full),
+    'Region': MaskFormat('Region', region_mask, region_unwrap, region_combine, region_empty, lambda mask: mask.crop.size < 1, region_is_full),
+    'Torch': MaskFormat(
+        'Torch',
+        torch_wrap,
+        lambda mask: mask.tensor.cpu().numpy(),
+        torch_combine,
+        lambda shape: TorchMask(torch.zeros(tuple(shape[:2]), dtype=torch.uint8, device=device)),
+        lambda mask: not bool(mask.tensor.any()),
+        lambda mask: bool(mask.tensor.all())
+    ),
+    'Dense': MaskFormat(
+        'Dense',
+        lambda mask: mask,
+        lambda mask: mask,
+        combine_masks,
+        lambda shape: np.zeros(shape[:2], dtype=np.uint8),
+        lambda mask: cv2.countNonZero(mask) == 0,
+        lambda mask: cv2.countNonZero(mask) == mask.size
+    )
+}
+
+def mask_format(name:str):
+    return mask_formats.get(name, mask_formats['Dense'])
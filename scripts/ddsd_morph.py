@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from functools import lru_cache
+from modules import shared
+
+# Kernel sizes above these use a distance transform threshold, whose cost does
+# not depend on the size. Below them cv2.dilate with a cached kernel is faster,
+# rectangular kernels are already separable row/column passes in OpenCV.
+morph_square_limit = 256
+morph_disk_limit = 15
+
+@lru_cache(maxsize=64)
+def morph_kernel(size, shape):
+    if shape == 'Disk': return cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+    return np.ones((size, size), np.uint8)
+
+def distance_dilate(mask, radius, metric):
+    distance = cv2.distanceTransform((mask == 0).astype(np.uint8), metric, cv2.DIST_MASK_PRECISE if metric == cv2.DIST_L2 else 3)
+    return (distance <= radius).astype(np.uint8) * np.uint8(255)
+
+# Chebyshev distance gives the odd square, an even size adds the 2x2 step so
+# the anchor matches cv2.dilate with np.ones((size, size)).
+def square_dilate(mask, size):
+    mask = distance_dilate(mask, (size - 1) // 2, cv2.DIST_C)
+    if size % 2 == 0: mask = cv2.dilate(mask, morph_kernel(2, 'Square'))
+    return mask
+
+def dilate(mask, size, shape=None):
+    if size < 2: return mask
+    shape = shape or shared.opts.data.get('ddsd_dilation_shape', 'Square')
+    if shape == 'Disk':
+        if size <= morph_disk_limit: return cv2.dilate(mask, morph_kernel(size, shape))
+        return distance_dilate(mask, size / 2, cv2.DIST_L2)
+    if size <= morph_square_limit: return cv2.dilate(mask, morph_kernel(size, shape))
+    return square_dilate(mask, size)
+
+# Same windows as dilate on a uint8 0/255 tensor, squares as two max pool
+# passes. Large disks have no cheap tensor form and go through the host.
+def dilate_tensor(mask, size, shape=None):
+    if size < 2: return mask
+    shape = shape or shared.opts.data.get('ddsd_dilation_shape', 'Square')
+    if shape == 'Disk' and size > morph_disk_limit:
+        return torch.from_numpy(dilate(mask.cpu().numpy(), size, shape)).to(mask.device)
+    left, right = size // 2, size - 1 - size // 2
+    with torch.no_grad():
+        x = mask[None, None].float()
+        if shape == 'Disk':
+            kernel = torch.from_numpy(morph_kernel(size, shape)).to(x)[None, None]
+            x = F.conv2d(F.pad(x, (left, right, left, right)), kernel)
+        else:
+            x = F.max_pool2d(F.pad(x, (left, right, 0, 0)), (1, size), stride=1)
+            x = F.max_pool2d(F.pad(x, (0, 0, left, right)), (size, 1), stride=1)
+        return (x[0, 0] > 0).to(torch.uint8).mul_(255)
@@ -0,0 +1,236 @@
+import copy
+import cv2
+import numpy as np
+import torch
+from PIL import Image, ImageFilter
+from modules import images, masking, processing, sd_vae, shared
+from modules.processing import StableDiffusionProcessingImg2Img
+try:
+    from modules.sd_samplers_cfg_denoiser import CFGDenoiser
+except ImportError:
+    from modules.sd_samplers_kdiffusion import CFGDenoiser
+from scripts.ddsd_mask import region_combine, region_paste, region_unwrap
+
+region_stats = {'regions':0, 'passes':0}
+latent_carry = {'key':None, 'image':None, 'latent':None, 'hits':0}
+
+def latent_carry_key(p):
+    if not shared.opts.data.get('ddsd_latent_carry', False): return None
+    if p.inpaint_full_res or p.image_mask is None or p.batch_size != 1 or len(p.init_images) != 1: return None
+    if p.restore_faces or shared.opts.data.get('img2img_color_correction', False): return None
+    if getattr(p.sd_model.model, 'conditioning_key', None) in ['hybrid', 'concat']: return None
+    return (p.sd_model.sd_model_hash, sd_vae.loaded_vae_file, p.width, p.height)
+
+# Whole picture passes keep the sampled latent, when the next pass starts from
+# the image decoded out of it on the same checkpoint/VAE/size its VAE encode is
+# replaced by that latent. Outside the mask the latent is the previous init
+# latent, so it does not drift through repeated encodes. Face restore and color
+# correction change the image after decoding, so those passes carry nothing.
+class LatentCarryProcessing(StableDiffusionProcessingImg2Img):
+    def init(self, all_prompts, all_seeds, all_subseeds):
+        key = latent_carry_key(self)
+        if key is None or key != latent_carry['key'] or self.init_images[0] is not latent_carry['image']:
+            return super().init(all_prompts, all_seeds, all_subseeds)
+        model, carried, used = self.sd_model, latent_carry['latent'], []
+        saved = {name: model.__dict__.get(name) for name in ['encode_first_stage', 'get_first_stage_encoding']}
+        model.encode_first_stage = lambda x: None
+        model.get_first_stage_encoding = lambda x: used.append(True) or carried
+        try:
+            super().init(all_prompts, all_seeds, all_subseeds)
+            if used: latent_carry['hits'] += 1
+        finally:
+            for name, value in saved.items():
+                if value is None: delattr(model, name)
+                else: setattr(model, name, value)
+
+    def sample(self, *args, **kwargs):
+        samples = super().sample(*args, **kwargs)
+        key = latent_carry_key(self)
+        latent_carry.update(key=key, image=None, latent=samples.detach() if key is not None else None)
+        return samples
+
+def latent_carry_bind(processed):
+    if latent_carry['key'] is not None: latent_carry['image'] = processed.images[0]
+
+def latent_carry_report():
+    report = latent_carry['hits']
+    latent_carry.update(key=None, image=None, latent=None, hits=0)
+    return report
+
+# Img2img over pre-cut crops with one latent mask per batch item, the crops and
+# masks are prepared like the full res inpaint path of a single pass.
+class RegionBatchProcessing(LatentCarryProcessing):
+    region_masks = []
+
+    def init(self, all_prompts, all_seeds, all_subseeds):
+        super().init(all_prompts, all_seeds, all_subseeds)
+        shape = self.init_latent.shape
+        latmask = np.stack([np.around(np.array(mask.convert('RGB').resize((shape[3], shape[2])), dtype=np.float32)[..., 0] / 255) for mask in self.region_masks])
+        latmask = np.repeat(latmask[:, None], shape[1], axis=1)
+        self.mask = torch.asarray(1.0 - latmask).to(shared.device).type(self.sd_model.dtype)
+        self.nmask = torch.asarray(latmask).to(shared.device).type(self.sd_model.dtype)
+
+# Inpainting, depth and instruct models condition on the mask or image of the
+# whole batch, those keep one pass per region.
+def region_batch_supported(pi):
+    return pi.inpaint_full_res and getattr(pi.sd_model.model, 'conditioning_key', None) not in ['hybrid', 'concat']
+
+# Same crop and blurred mask as the full res inpaint path, worked out on the
+# region box plus the blur reach so the full frame is never built. The mask is
+# returned cut to the crop.
+def region_crop(pi, region):
+    h, w = region.shape
+    local = region_pad(region.box, int(pi.mask_blur * 3) + 1 if pi.mask_blur else 0, region.shape)
+    blur = Image.fromarray(region_paste(region, local))
+    if pi.mask_blur: blur = blur.filter(ImageFilter.GaussianBlur(pi.mask_blur))
+    x, y, bw, bh = cv2.boundingRect(np.array(blur))
+    pad = pi.inpaint_full_res_padding
+    crop = (max(local[1] + x - pad, 0), max(local[0] + y - pad, 0), min(local[1] + x + bw + pad, w), min(local[0] + y + bh + pad, h))
+    crop = masking.expand_crop_region(crop, pi.width, pi.height, w, h)
+    mask = Image.new('L', (crop[2] - crop[0], crop[3] - crop[1]))
+    mask.paste(blur, (local[1] - crop[0], local[0] - crop[1]))
+    return crop, mask
+
+def crops_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+# Groups of (region, seed, crop) inpainted in one sampler call, regions are
+# RegionMask. Every full res crop is resized to the pass width/height, so a
+# group is one size bucket.
+# A region goes after the last group holding a crop it overlaps, overlapping
+# regions keep their order and see each other's result.
+def region_batches(pi, regions, seeds):
+    limit = int(shared.opts.data.get('ddsd_region_batch_size', 4))
+    region_stats['regions'] += len(regions)
+    if limit < 2 or len(regions) < 2 or not region_batch_supported(pi):
+        region_stats['passes'] += len(regions)
+        return [[(region, seed, None)] for region, seed in zip(regions, seeds)]
+    groups = []
+    for region, seed in zip(regions, seeds):
+        crop = region_crop(pi, region)
+        start = 0
+        for index, group in enumerate(groups):
+            if any(crops_overlap(crop[0], other[0]) for _, _, other in group): start = index + 1
+        while start < len(groups) and len(groups[start]) >= limit: start += 1
+        if start == len(groups): groups.append([])
+        groups[start].append((region, seed, crop))
+    region_stats['passes'] += len(groups)
+    return groups
+
+def region_batch_inpaint(pi, init_image, group):
+    if len(group) < 2:
+        pi.seed = group[0][1]
+        pi.init_images = [init_image]
+        pi.image_mask = Image.fromarray(region_unwrap(group[0][0]))
+        processed = processing.process_images(pi)
+        latent_carry_bind(processed)
+        return processed.images[0], processed
+    image = init_image.convert('RGB')
+    batch = copy.copy(pi)
+    batch.__class__ = RegionBatchProcessing
+    batch.init_images = [images.resize_image(2, image.crop(crop), pi.width, pi.height) for _, _, (crop, _) in group]
+    batch.region_masks = [images.resize_image(2, mask, pi.width, pi.height) for _, _, (_, mask) in group]
+    batch.image_mask = None
+    batch.batch_size = len(group)
+    batch.seed = [seed for _, seed, _ in group]
+    batch.subseed = [pi.subseed] * len(group)
+    processed = processing.process_images(batch)
+    for index, (_, _, (crop, mask)) in enumerate(group):
+        x1, y1, x2, y2 = crop
+        image.paste(images.resize_image(1, processed.images[index], x2 - x1, y2 - y1), (x1, y1), mask)
+    return image, processed
+
+def region_pad(box, padding, shape):
+    return (max(box[0] - padding, 0), max(box[1] - padding, 0), min(box[2] + padding, shape[0]), min(box[3] + padding, shape[1]))
+
+# Greedy merge of split regions whose padded boxes overlap or whose joint padded
+# box fits in a window x window square, a merged cluster is inpainted once.
+def region_clusters(regions, padding, window):
+    clusters = list(regions)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(clusters)):
+            a = region_pad(clusters[i].box, padding, clusters[i].shape)
+            for j in range(i + 1, len(clusters)):
+                b = region_pad(clusters[j].box, padding, clusters[j].shape)
+                if crops_overlap(a, b) or max(a[2], b[2]) - min(a[0], b[0]) <= window and max(a[3], b[3]) - min(a[1], b[1]) <= window:
+                    clusters[i] = region_combine(clusters[i], 'OR', clusters.pop(j))
+                    merged = True
+                    break
+            if merged: break
+    return clusters
+
+# Consecutive detect passes on the same checkpoint/VAE/denoise/CFG/steps and
+# negative prompt, index -> first index of the group, groups of one are left out.
+# Passes that split their mask into regions or cap them (splits) keep their own
+# run, the union of a group is inpainted whole.
+def regional_groups(prompts, positives, negatives, settings, splits):
+    groups, start = {}, None
+    for index in range(len(prompts)):
+        usable = len(prompts[index]) > 0 and ' AND ' not in positives[index] and not splits[index]
+        if usable and start is not None and settings[index] == settings[start] and negatives[index] == negatives[start]:
+            groups[start] = groups[index] = start
+        elif usable:
+            start = index
+        else:
+            start = None
+    return groups
+
+# Latent couple style combine, each AND subprompt guides the latent through the
+# mask of its detect pass. Where the masks overlap their weights are averaged.
+def regional_combine(masks):
+    def combine_denoised(self, x_out, conds_list, uncond, cond_scale):
+        denoised_uncond = x_out[-uncond.shape[0]:]
+        denoised = torch.clone(denoised_uncond)
+        for i, conds in enumerate(conds_list):
+            for region, (cond_index, weight) in enumerate(conds):
+                denoised[i] += (x_out[cond_index] - denoised_uncond[i]) * (weight * cond_scale) * masks[min(region, len(masks) - 1)]
+        return denoised
+    return combine_denoised
+
+class RegionalPromptProcessing(LatentCarryProcessing):
+    prompt_masks = []
+
+    def sample(self, *args, **kwargs):
+        h, w = self.init_latent.shape[2:]
+        masks = []
+        for mask in self.prompt_masks:
+            if getattr(self, 'paste_to', None):
+                x, y, pw, ph = self.paste_to
+                mask = mask.crop((x, y, x + pw, y + ph))
+            masks.append(np.array(mask.resize((w, h), Image.BILINEAR), dtype=np.float32) / 255)
+        masks = np.stack(masks)
+        total = masks.sum(0)
+        masks = np.where(total > 0, masks / np.maximum(total, 1e-6), 1 / len(masks))
+        masks = torch.asarray(masks[:, None]).to(shared.device).type(self.sd_model.dtype)
+        original = CFGDenoiser.combine_denoised
+        CFGDenoiser.combine_denoised = regional_combine(masks)
+        try:
+            return super().sample(*args, **kwargs)
+        finally:
+            CFGDenoiser.combine_denoised = original
+
+# pending is [(pi, mask)] of one group, inpainted in one run over the union of
+# the masks with the prompts joined by AND. Styles are applied per subprompt.
+def regional_inpaint(init_image, pending, seed):
+    pi = pending[0][0]
+    batch = copy.copy(pi)
+    batch.__class__ = RegionalPromptProcessing
+    batch.prompt_masks = [Image.fromarray(mask) for _, mask in pending]
+    batch.prompt = ' AND '.join(shared.prompt_styles.apply_styles_to_prompt(member.prompt, pi.styles) for member, _ in pending)
+    batch.negative_prompt = shared.prompt_styles.apply_negative_styles_to_prompt(pi.negative_prompt, pi.styles)
+    batch.styles = []
+    batch.seed = seed
+    batch.init_images = [init_image]
+    batch.image_mask = Image.fromarray(np.maximum.reduce([mask for _, mask in pending]))
+    processed = processing.process_images(batch)
+    latent_carry_bind(processed)
+    return processed.images[0], processed
+
+def region_report():
+    report = None
+    if region_stats['passes'] < region_stats['regions']:
+        report = f"{region_stats['passes']}/{region_stats['regions']}"
+    region_stats['regions'] = region_stats['passes'] = 0
+    return report
@@ -3,6 +3,11 @@ import numpy as np
 import torch
 import gc
 import cv2
+import math
+import hashlib
+import importlib.util
+import threading
+import torch.nn.functional as F
 
 from modules import shared
 from modules.paths import models_path
@@ -11,24 +16,86 @@ from modules.devices import device, torch_gc, cpu
 
 from PIL import Image
 from collections import OrderedDict
+from contextlib import contextmanager
 from scipy.ndimage import binary_dilation
 from segment_anything import SamPredictor, sam_model_registry
+from segment_anything.utils.transforms import ResizeLongestSide
 from scripts.ddsd_dino import dino_predict_internal, clear_dino_cache
+from scripts.ddsd_mask import mask_downscale, mask_work_shape, tensor_downscale
+from scripts.ddsd_morph import dilate, dilate_tensor
+
+try:
+    from mobile_sam import sam_model_registry as mobile_sam_model_registry
+except ImportError:
+    mobile_sam_model_registry = None
 
 sam_model_cache = OrderedDict()
+sam_backends = OrderedDict()
+sam_mask_memo = OrderedDict()
+sam_mask_memo_stats = {'hit': 0, 'miss': 0}
+sam_fast_iou_stats = []
+# DINO/SAM inference and their caches are used by one leaf at a time
+sam_model_lock = threading.RLock()
 sam_model_dir = os.path.join(models_path, "sam")
 
+# A segmenter backend is a (match, build) pair. match(file_name) tells whether the
+# backend handles a checkpoint in models/sam, build(checkpoint_path) returns a model
+# with the segment_anything Sam interface: image_encoder (with img_size),
+# prompt_encoder, mask_decoder, preprocess, postprocess_masks, mask_threshold and
+# image_format. A checkpoint with a sidecar python file (name.pth + name.py) is
+# built by the build_sam(checkpoint_path) function of that file, so local stand-in
+# models only need to implement that interface.
+def register_sam_backend(name, match, build):
+    sam_backends[name] = (match, build)
+
+def sam_sidecar_file(sam_checkpoint):
+    return os.path.join(sam_model_dir, os.path.splitext(sam_checkpoint)[0] + '.py')
+
+def build_sidecar_sam(sam_checkpoint):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(sam_checkpoint))[0], sam_sidecar_file(os.path.basename(sam_checkpoint)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.build_sam(sam_checkpoint)
+
+def sam_model_type(sam_checkpoint):
+    return '_'.join(os.path.basename(sam_checkpoint).split('_')[1:-1])
+
+register_sam_backend(
+    'sidecar',
+    lambda x: x.endswith(('.pth', '.pt')) and os.path.isfile(sam_sidecar_file(x)),
+    build_sidecar_sam
+)
+if mobile_sam_model_registry is not None:
+    register_sam_backend(
+        'mobile_sam',
+        lambda x: x.endswith(('.pth', '.pt')) and 'mobile_sam' in x.lower(),
+        lambda x: mobile_sam_model_registry['vit_t'](checkpoint=x)
+    )
+register_sam_backend(
+    'segment_anything',
+    lambda x: x.endswith('.pth') and sam_model_type(x) in sam_model_registry,
+    lambda x: sam_model_registry[sam_model_type(x)](checkpoint=x)
+)
+
+def sam_backend(sam_checkpoint):
+    for name, (match, build) in sam_backends.items():
+        if match(sam_checkpoint): return name, build
+    return None, None
+
 def sam_model_list():
-    return [x for x in os.listdir(sam_model_dir) if x.endswith('.pth')]
+    return [x for x in os.listdir(sam_model_dir) if sam_backend(x)[0] is not None]
 
 def load_sam_model(sam_checkpoint):
-    model_type = '_'.join(sam_checkpoint.split('_')[1:-1])
+    backend, build = sam_backend(sam_checkpoint)
+    print(f'Loading SAM {sam_checkpoint} with {backend} backend')
     sam_checkpoint = os.path.join(sam_model_dir, sam_checkpoint)
     torch.load = unsafe_torch_load
-    sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
+    try:
+        sam = build(sam_checkpoint)
+    finally:
+        torch.load = load
     sam.to(device=device)
     sam.eval()
-    torch.load = load
     return sam
 
 def clear_sam_cache():
@@ -41,8 +108,12 @@ def clear_cache():
     clear_dino_cache()
 
 def dilate_mask(mask, dilation):
-    dilation_kernel = np.ones((dilation, dilation), np.uint8)
-    return cv2.dilate(mask, dilation_kernel)
+    x, y, w, h = cv2.boundingRect(mask)
+    if w < 1 or dilation < 2: return mask
+    y0, x0 = max(y - dilation, 0), max(x - dilation, 0)
+    y1, x1 = min(y + h + dilation, mask.shape[0]), min(x + w + dilation, mask.shape[1])
+    mask[y0:y1, x0:x1] = dilate(mask[y0:y1, x0:x1], dilation)
+    return mask
 
 def init_sam_model(sam_model_name):
     print('Initializing SAM')
@@ -58,32 +129,243 @@ def init_sam_model(sam_model_name):
     else:
         Exception(f'{sam_model_name} not found, please download model to models/sam')
 
-def sam_predict(sam_model_name, dino_model_name, image, image_np, image_np_rgb, dino_text, dino_box_threshold, dilation, sam_level):
+def sam_crop_windows(boxes, width, height, padding):
+    windows = []
+    for x0, y0, x1, y1 in boxes.tolist():
+        pad = max(16, int(max(x1 - x0, y1 - y0) * padding / 100))
+        windows.append([max(0, int(x0) - pad), max(0, int(y0) - pad), min(width, int(math.ceil(x1)) + pad), min(height, int(math.ceil(y1)) + pad)])
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(windows)):
+            for j in range(i + 1, len(windows)):
+                a, b = windows[i], windows[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    windows[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del windows[j]
+                    merged = True
+                    break
+            if merged: break
+    if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in windows) * 2 > width * height: return []
+    return windows
+
+def sam_encode_windows(sam, predictor, crops, batch_size):
+    inputs = []
+    for crop in crops:
+        input_image = predictor.transform.apply_image(crop)
+        input_image = torch.as_tensor(input_image, device=device).permute(2, 0, 1).contiguous()[None, :, :, :]
+        inputs.append((tuple(input_image.shape[-2:]), sam.preprocess(input_image)))
+    features = []
+    with torch.no_grad():
+        for index in range(0, len(inputs), batch_size):
+            features += list(sam.image_encoder(torch.cat([x for _, x in inputs[index:index + batch_size]])).split(1))
+    return [(input_size, feature) for (input_size, _), feature in zip(inputs, features)]
+
+def sam_mask_crop(mask, offset):
+    rows = torch.nonzero(mask.any(dim=1)).flatten()
+    cols = torch.nonzero(mask.any(dim=0)).flatten()
+    if rows.numel() < 1: return offset[0], offset[1], np.zeros((0, 0), dtype=bool)
+    y0, y1, x0, x1 = rows[0].item(), rows[-1].item() + 1, cols[0].item(), cols[-1].item() + 1
+    return offset[0] + x0, offset[1] + y0, mask[y0:y1, x0:x1].cpu().numpy().copy()
+
+def sam_memo_region(image_np_rgb, box, x, y, crop):
+    x0, y0 = min(int(box[0]), x), min(int(box[1]), y)
+    x1, y1 = max(int(math.ceil(box[2])), x + crop.shape[1]), max(int(math.ceil(box[3])), y + crop.shape[0])
+    region = np.ascontiguousarray(image_np_rgb[max(0, y0):y1, max(0, x0):x1])
+    return hashlib.blake2b(region.tobytes(), digest_size=16).digest()
+
+def sam_memo_iou(box, other):
+    w = min(box[2], other[2]) - max(box[0], other[0])
+    h = min(box[3], other[3]) - max(box[1], other[1])
+    if w <= 0 or h <= 0: return 0
+    inter = w * h
+    return inter / ((box[2] - box[0]) * (box[3] - box[1]) + (other[2] - other[0]) * (other[3] - other[1]) - inter)
+
+def sam_memo_lookup(key, image_np_rgb, boxes):
+    tolerance = shared.opts.data.get('ddsd_sam_memo_iou', 0.9)
+    hits, misses = [], []
+    for index, box in enumerate(boxes.tolist()):
+        best, best_iou = None, tolerance
+        for memo_index, (memo_key, memo_box, _, _, _, _) in sam_mask_memo.items():
+            if memo_key != key: continue
+            iou = sam_memo_iou(box, memo_box)
+            if iou >= best_iou: best, best_iou = memo_index, iou
+        if best is not None:
+            _, memo_box, digest, x, y, crop = sam_mask_memo[best]
+            if sam_memo_region(image_np_rgb, memo_box, x, y, crop) == digest:
+                sam_mask_memo.move_to_end(best)
+                hits.append((x, y, crop))
+                continue
+        misses.append(index)
+    sam_mask_memo_stats['hit'] += len(hits)
+    sam_mask_memo_stats['miss'] += len(misses)
+    print(f'SAM Memo hit {len(hits)}/{boxes.shape[0]} boxes')
+    return hits, boxes[misses]
+
+def sam_memo_store(key, image_np_rgb, decoded):
+    for box, x, y, crop in decoded:
+        sam_mask_memo[(key, tuple(box), x, y)] = (key, box, sam_memo_region(image_np_rgb, box, x, y, crop), x, y, crop)
+    while len(sam_mask_memo) > shared.opts.data.get('ddsd_sam_memo_size', 64):
+        sam_mask_memo.popitem(last=False)
+
+def sam_memo_report():
+    total = sam_mask_memo_stats['hit'] + sam_mask_memo_stats['miss']
+    report = f"{sam_mask_memo_stats['hit']}/{total}" if total > 0 else None
+    sam_mask_memo_stats['hit'] = 0
+    sam_mask_memo_stats['miss'] = 0
+    return report
+
+def sam_decode_boxes(sam, predictor, boxes, sam_level, out, offset=(0, 0), decoded=None):
+    chunk_size = shared.opts.data.get('ddsd_sam_decode_chunk', 16)
+    transformed_boxes = predictor.transform.apply_boxes_torch(boxes, predictor.original_size).to(device)
+    with torch.no_grad():
+        for index in range(0, transformed_boxes.shape[0], chunk_size):
+            sparse_embeddings, dense_embeddings = sam.prompt_encoder(
+                points = None,
+                boxes = transformed_boxes[index:index + chunk_size],
+                masks = None
+            )
+            low_res_masks, _ = sam.mask_decoder(
+                image_embeddings = predictor.features,
+                image_pe = sam.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings = sparse_embeddings,
+                dense_prompt_embeddings = dense_embeddings,
+                multimask_output = True
+            )
+            masks = sam.postprocess_masks(low_res_masks[:, sam_level:sam_level + 1], predictor.input_size, predictor.original_size)
+            masks = masks[:, 0] > sam.mask_threshold
+            out |= masks.any(dim=0)
+            if decoded is not None:
+                for box, mask in zip(boxes[index:index + chunk_size].tolist(), masks):
+                    decoded.append(([box[0] + offset[0], box[1] + offset[1], box[2] + offset[0], box[3] + offset[1]], *sam_mask_crop(mask, offset)))
+            del sparse_embeddings, dense_embeddings, low_res_masks, masks
+    return out
+
+@contextmanager
+def sam_encoder_size(sam, predictor, sam_size):
+    encoder = sam.image_encoder
+    if sam_size >= encoder.img_size or getattr(encoder, 'pos_embed', None) is None:
+        yield predictor
+        return
+    img_size, pos_embed = encoder.img_size, encoder.pos_embed
+    input_image_size, image_embedding_size = sam.prompt_encoder.input_image_size, sam.prompt_encoder.image_embedding_size
+    embed_size = sam_size // (img_size // pos_embed.shape[1])
+    with torch.no_grad():
+        resized = F.interpolate(pos_embed.permute(0, 3, 1, 2), size=(embed_size, embed_size), mode='bicubic', align_corners=False)
+    encoder.img_size = sam_size
+    encoder.pos_embed = torch.nn.Parameter(resized.permute(0, 2, 3, 1), requires_grad=False)
+    sam.prompt_encoder.input_image_size = (sam_size, sam_size)
+    sam.prompt_encoder.image_embedding_size = (embed_size, embed_size)
+    predictor.transform = ResizeLongestSide(sam_size)
+    try:
+        yield predictor
+    finally:
+        encoder.img_size, encoder.pos_embed = img_size, pos_embed
+        sam.prompt_encoder.input_image_size, sam.prompt_encoder.image_embedding_size = input_image_size, image_embedding_size
+        predictor.transform = ResizeLongestSide(img_size)
+
+def sam_predict_windows(sam, predictor, image_np_rgb, boxes, windows, sam_level, result, decoded=None):
+    crops = [image_np_rgb[y0:y1, x0:x1] for x0, y0, x1, y1 in windows]
+    encoded = sam_encode_windows(sam, predictor, crops, shared.opts.data.get('ddsd_sam_crop_batch', 4))
+    centers = ((boxes[:, :2] + boxes[:, 2:]) / 2).tolist()
+    for (x0, y0, x1, y1), crop, (input_size, feature) in zip(windows, crops, encoded):
+        inside = torch.tensor([x0 <= cx < x1 and y0 <= cy < y1 for cx, cy in centers], dtype=torch.bool)
+        if not inside.any(): continue
+        predictor.features = feature
+        predictor.original_size = crop.shape[:2]
+        predictor.input_size = input_size
+        predictor.is_image_set = True
+        sam_decode_boxes(sam, predictor, boxes[inside] - torch.Tensor([x0, y0, x0, y0]), sam_level, result[y0:y1, x0:x1], (x0, y0), decoded)
+    print(f'SAM Cropped Windows {len(windows)} for {boxes.shape[0]} boxes')
+    return result
+
+def box_mask_predict(boxes, shape, mask_mode):
+    mask = np.zeros(shape, dtype=np.uint8)
+    for x0, y0, x1, y1 in boxes.round().int().tolist():
+        if mask_mode == 'ELLIPSE':
+            cv2.ellipse(mask, (((x0 + x1) / 2, (y0 + y1) / 2), (x1 - x0, y1 - y0), 0), 255, -1)
+        elif mask_mode == 'ROUND':
+            radius = max(1, min(x1 - x0, y1 - y0) // 4)
+            cv2.rectangle(mask, (x0 + radius, y0), (x1 - radius, y1), 255, -1)
+            cv2.rectangle(mask, (x0, y0 + radius), (x1, y1 - radius), 255, -1)
+            for cx, cy in [(x0 + radius, y0 + radius), (x1 - radius, y0 + radius), (x0 + radius, y1 - radius), (x1 - radius, y1 - radius)]:
+                cv2.circle(mask, (cx, cy), radius, 255, -1)
+        else:
+            cv2.rectangle(mask, (x0, y0), (x1, y1), 255, -1)
+    return mask
+
+def sam_predict_boxes(sam, image_np_rgb, boxes, sam_level, result, decoded=None, sam_size=1024):
+    windows = []
+    if shared.opts.data.get('ddsd_sam_crop_windows', False):
+        windows = sam_crop_windows(boxes, image_np_rgb.shape[1], image_np_rgb.shape[0], shared.opts.data.get('ddsd_sam_crop_padding', 25))
+    with sam_encoder_size(sam, SamPredictor(sam), sam_size) as predictor:
+        if windows:
+            sam_predict_windows(sam, predictor, image_np_rgb, boxes, windows, sam_level, result, decoded)
+        else:
+            predictor.set_image(image_np_rgb)
+            sam_decode_boxes(sam, predictor, boxes, sam_level, result, decoded=decoded)
+    return result
+
+def sam_compare_encoder_size(sam, image_np_rgb, boxes, sam_level, result):
+    baseline = sam_predict_boxes(sam, image_np_rgb, boxes, sam_level, torch.zeros_like(result))
+    union = (baseline | result).sum().item()
+    iou = (baseline & result).sum().item() / union if union > 0 else 1.0
+    sam_fast_iou_stats.append(iou)
+    print(f'SAM Fast Mode IoU against {sam.image_encoder.img_size}: {iou:.4f}')
+    return iou
+
+def sam_fast_iou_report():
+    report = f'{min(sam_fast_iou_stats):.4f}/{sum(sam_fast_iou_stats) / len(sam_fast_iou_stats):.4f}' if sam_fast_iou_stats else None
+    sam_fast_iou_stats.clear()
+    return report
+
+def sam_predict(sam_model_name, dino_model_name, image, image_np, image_np_rgb, dino_text, dino_box_threshold, dilation, sam_level, mask_mode='SAM', sam_size=1024, boxes=None, scale=1.0, mask_device=False):
     print('Start SAM Processing')
     
     assert dino_text, 'Please input dino text'
     
-    boxes = dino_predict_internal(image, dino_model_name, dino_text, dino_box_threshold)
+    if boxes is None:
+        with sam_model_lock:
+            boxes = dino_predict_internal(image, dino_model_name, dino_text, dino_box_threshold)
     
     if boxes.shape[0] < 1: return None
     
-    sam = init_sam_model(sam_model_name)
+    shape = mask_work_shape(image_np.shape, scale)
+    dilation = round(dilation * scale)
+    if mask_mode != 'SAM':
+        print(f'Create {mask_mode} Box Mask {boxes.shape[0]} boxes')
+        return dilate_mask(box_mask_predict(boxes * scale, shape, mask_mode), dilation)
     
-    print(f'Running SAM Inference {image_np_rgb.shape}')
-    predictor = SamPredictor(sam)
-    predictor.set_image(image_np_rgb)
-    transformed_boxes = predictor.transform.apply_boxes_torch(boxes, image_np.shape[:2])
-    masks, _, _ = predictor.predict_torch(
-        point_coords = None,
-        point_labels = None,
-        boxes = transformed_boxes.to(device),
-        multimask_output = True
-    )
-    
-    masks = masks.permute(1,0,2,3).cpu().numpy()
+    with sam_model_lock:
+        result = torch.zeros(image_np.shape[:2], dtype=torch.bool, device=device)
+        memo_key = (sam_model_name, sam_level, sam_size, image_np.shape[:2])
+        decoded = None
+        if shared.opts.data.get('ddsd_sam_memo', False):
+            hits, boxes = sam_memo_lookup(memo_key, image_np_rgb, boxes)
+            for x, y, crop in hits:
+                result[y:y + crop.shape[0], x:x + crop.shape[1]] |= torch.from_numpy(crop).to(device)
+            decoded = []
     
-    if shared.cmd_opts.lowvram:
-        sam.to(cpu)
-    clear_sam_cache()
+        if boxes.shape[0] > 0:
+            sam = init_sam_model(sam_model_name)
+        
+            print(f'Running SAM Inference {image_np_rgb.shape} at {min(sam_size, sam.image_encoder.img_size)}')
+            # Memo hits are already in result, the comparison only covers the
+            # boxes decoded here so it gets their mask on its own.
+            compare = sam_size < sam.image_encoder.img_size and shared.opts.data.get('ddsd_sam_fast_compare', False)
+            fast = torch.zeros_like(result) if compare else result
+            sam_predict_boxes(sam, image_np_rgb, boxes, sam_level, fast, decoded, sam_size)
+            if compare:
+                result |= fast
+                sam_compare_encoder_size(sam, image_np_rgb, boxes, sam_level, fast)
+        
+            if shared.cmd_opts.lowvram:
+                sam.to(cpu)
+            clear_sam_cache()
+            if decoded is not None: sam_memo_store(memo_key, image_np_rgb, decoded)
+        mask = result.to(torch.uint8).mul_(255)
+        if not mask_device: mask = mask.cpu().numpy()
+        del result
     
-    return dilate_mask(np.any(masks[sam_level], axis=0).astype(np.uint8) * 255,dilation)
\ No newline at end of file
+    if mask_device: return dilate_tensor(tensor_downscale(mask, shape), dilation)
+    return dilate_mask(mask_downscale(mask, shape),dilation)
\ No newline at end of file
@@ -1,189 +1,254 @@
 import os
-import re
 import numpy as np
 import cv2
 import gc
+import torch
 import matplotlib.font_manager
-from glob import glob
+from collections import OrderedDict
 from PIL import Image, ImageDraw, ImageFont
-from scripts.ddsd_sam import sam_predict, clear_cache, dilate_mask
+from concurrent.futures import ThreadPoolExecutor, wait
+from scripts.ddsd_sam import sam_predict, sam_model_lock, clear_cache, dilate_mask
+from scripts.ddsd_dino import dino_predict_internal
+from scripts.ddsd_expr import ExprBackend, ExprJob, compile_expression, evaluate_plan, expression_const_cache, prompt_spliter
+from scripts.ddsd_mask import RegionMask, guided_upsample, mask_format, mask_work_shape, region_combine, select_regions
+from scripts.ddsd_vector import load_vector_mask, rasterize_vector_mask, vector_ext
+from scripts.ddsd_region import LatentCarryProcessing
+from modules import shared
 from modules.devices import torch_gc
-from skimage import measure
 
 from modules.paths import models_path
-from modules.processing import StableDiffusionProcessingImg2Img
-
-token_split = re.compile(r"(AND|OR|NOR|XOR|NAND)")
-token_first = re.compile(r'\(([^()]+)\)')
-token_match = re.compile(r'(\d+)GROUPMASK')
-token_file = re.compile(r'\s*<(.*)>\s*')
 
 ddsd_mask_path = os.path.join(models_path, "ddsdmask")
 mask_embed = {}
+mask_embed_dirs = {}
+mask_embed_cache = OrderedDict()
+mask_embed_ext = ['.png', '.jpg', '.jpeg', '.webp'] + vector_ext
+leaf_pool = [0, None]
 
 def startup():
-    global mask_embed
     if not os.path.exists(ddsd_mask_path):
         os.makedirs(ddsd_mask_path)
         with open(os.path.join(ddsd_mask_path, 'put_in_mask_here.txt'),'w') as f: pass
-    
-    masks = glob(os.path.join(ddsd_mask_path,'**\\*'))
-    masks = [(x, *os.path.splitext(os.path.basename(x))) for x in masks if os.path.isfile(x)]
-    masks = [(x, y) for x, y, z in masks if z in ['.png', '.jpg', '.jpeg', '.webp']]
-    mask_embed = {y.upper():x for x, y in masks}
+    mask_embed_refresh()
 
-startup()
+def mask_embed_scan(path):
+    files, dirs = {}, []
+    for entry in os.scandir(path):
+        name, ext = os.path.splitext(entry.name)
+        if entry.is_dir(): dirs.append(entry.path)
+        elif ext.lower() in mask_embed_ext: files[name.upper()] = entry.path
+    return files, dirs
 
-def try_convert(data, type, default, min, max):
-    try:
-        convert = type(data)
-        if convert < min: return min
-        if convert > max: return max
-        return convert
-    except (ValueError, TypeError):
-        return default
-    
-def prompt_spliter(prompt:str, split_token:str, count:int):
-    spliter = prompt.split(split_token)
-    while len(spliter) < count:
-        spliter.append('')
-    return spliter[:count]
+# Directories are only listed again when their mtime changes, files are
+# stat'ed so a mask saved over an existing one is decoded again.
+def mask_embed_refresh():
+    pending = list(mask_embed_dirs.keys()) or [ddsd_mask_path]
+    while pending:
+        path = pending.pop()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mask_embed_dirs.pop(path, None)
+            continue
+        if path in mask_embed_dirs and mask_embed_dirs[path][0] == mtime: continue
+        files, dirs = mask_embed_scan(path)
+        mask_embed_dirs[path] = (mtime, files)
+        pending.extend(x for x in dirs if x not in mask_embed_dirs)
+    embed = {}
+    for path in sorted(mask_embed_dirs.keys()):
+        for name, file in mask_embed_dirs[path][1].items():
+            try:
+                embed[name] = (file, os.stat(file).st_mtime)
+            except OSError:
+                pass
+    if embed != mask_embed:
+        mask_embed.clear()
+        mask_embed.update(embed)
+        expression_const_cache.clear()
 
-def combine_masks(mask, combine_masks_option, mask2):
-    if combine_masks_option == 'AND': return cv2.bitwise_and(mask, mask2)
-    if combine_masks_option == 'OR': return cv2.bitwise_or(mask, mask2)
-    if combine_masks_option == 'XOR': return cv2.bitwise_xor(mask, mask2)
-    if combine_masks_option == 'NOR': return cv2.bitwise_not(cv2.bitwise_or(mask, mask2))
-    if combine_masks_option == 'NAND': return cv2.bitwise_not(cv2.bitwise_and(mask,mask2))
+def mask_vector_load(file, mtime):
+    key = (file, mtime, None)
+    if key not in mask_embed_cache:
+        mask_embed_cache[key] = load_vector_mask(file)
+    mask_embed_cache.move_to_end(key)
+    return mask_embed_cache[key]
 
-def dino_detect_from_prompt(prompt:str, detailer_sam_model, detailer_dino_model, init_image, disable_mask_paint_mode, inpaint_mask_mode, image_mask):
+def mask_embed_load(name, shape):
+    file, mtime = mask_embed[name]
+    key = (file, mtime, shape[:2])
+    if key in mask_embed_cache:
+        mask_embed_cache.move_to_end(key)
+        return mask_embed_cache[key]
+    if os.path.splitext(file)[1].lower() in vector_ext:
+        mask = rasterize_vector_mask(mask_vector_load(file, mtime), shape)
+    else:
+        image = Image.open(file)
+        image.draft('L', (shape[1], shape[0]))
+        mask = np.array(image.convert('L').resize((shape[1], shape[0])))
+    mask_embed_cache[key] = mask
+    while len(mask_embed_cache) > shared.opts.data.get('ddsd_mask_embed_cache', 16):
+        mask_embed_cache.popitem(last=False)
+    return mask
+
+startup()
+
+def dino_detect_from_prompt(prompt:str, detailer_sam_model, detailer_dino_model, init_image, disable_mask_paint_mode, inpaint_mask_mode, image_mask, sam_size=1024, job=None):
     clear_cache()
-    image_np_zero = np.array(init_image.convert('L'))
-    image_np_zero[:,:] = 0
     image_np = np.array(init_image)
     image_np_rgb = image_np[:,:,:3].copy()
-    image_set = (init_image, image_np, image_np_rgb, image_np_zero)
-    model_set = (detailer_sam_model, detailer_dino_model)
-    result = dino_prompt_detector(prompt, model_set, image_set)
+    mask_embed_refresh()
+    mask_set = mask_format(shared.opts.data.get('ddsd_mask_format', 'Dense'))
+    scale = shared.opts.data.get('ddsd_mask_scale', 1.0)
+    if job is None: job = ExprJob([compile_expression(prompt)])
+    job.update(init_image, (sam_size, mask_set.name, scale))
+    image_set = (init_image, image_np, image_np_rgb, mask_work_shape(image_np.shape, scale), job.boxes)
+    model_set = (detailer_sam_model, detailer_dino_model, sam_size, scale)
+    result = dino_prompt_detector(prompt, model_set, image_set, mask_set, job)
     clear_cache()
-    if np.array_equal(result, image_np_zero): return None
-    if disable_mask_paint_mode: return result
-    if image_mask is None: return result
-    image_mask = np.array(image_mask.resize((result.shape[1],result.shape[0])).convert('L'))
-    image_mask = np.resize(image_mask, result.shape)
-    if inpaint_mask_mode == 'Inner': return cv2.bitwise_and(result, image_mask)
-    if inpaint_mask_mode == 'Outer': return cv2.bitwise_and(result, cv2.bitwise_not(image_mask))
-    return None
+    if mask_set.is_empty(result): return None
+    if scale < 1:
+        result = mask_set.wrap(guided_upsample(mask_set.unwrap(result), np.array(init_image.convert('L')), max(2, round(2 / scale))))
+    if disable_mask_paint_mode or image_mask is None: return mask_set.unwrap(result)
+    if inpaint_mask_mode not in ['Inner', 'Outer']: return None
+    image_mask = np.array(image_mask.resize((image_np.shape[1],image_np.shape[0])).convert('L'))
+    image_mask = mask_set.wrap(np.resize(image_mask, image_np.shape[:2]))
+    if inpaint_mask_mode == 'Outer': image_mask = mask_set.combine(image_mask, 'NOR', image_mask)
+    return mask_set.unwrap(mask_set.combine(result, 'AND', image_mask))
     
-def dino_prompt_token_file(prompt:str, image_np_zero):
-    usage_type, usage, dilation = prompt_spliter(prompt, ':', 3)
-    usage_type = usage_type.upper()
-    usage = usage.upper()
+def dino_prompt_token_file(value, shape, scale=1.0):
+    usage_type, usage, dilation = value
+    image_np_zero = np.zeros(shape, dtype=np.uint8)
     if usage_type == 'AREA':
         if usage == 'LEFT':
             image_np_zero[:,:image_np_zero.shape[1] // 2] = 255
-            image_np_zero[:,image_np_zero.shape[1] // 2:] = 0
         elif usage == 'RIGHT':
-            image_np_zero[:,:image_np_zero.shape[1] // 2] = 0
             image_np_zero[:,image_np_zero.shape[1] // 2:] = 255
         elif usage == 'TOP':
             image_np_zero[:image_np_zero.shape[0] // 2,:] = 255
-            image_np_zero[image_np_zero.shape[0] // 2:,:] = 0
         elif usage == 'BOTTOM':
-            image_np_zero[:image_np_zero.shape[0] // 2,:] = 0
             image_np_zero[image_np_zero.shape[0] // 2:,:] = 255
         elif usage == 'ALL':
             image_np_zero[:,:] = 255
     if usage_type == 'FILE':
         if usage in mask_embed:
-            image = Image.open(mask_embed[usage]).convert('L')
-            h, w = image_np_zero.shape[:2]
-            image = image.resize((w, h))
-            image_np_zero = np.array(image)
-    return dilate_mask(image_np_zero, try_convert(dilation, int, 2, 0, 512))
+            image_np_zero = mask_embed_load(usage, image_np_zero.shape).copy()
+        else:
+            print(f'Mask file {usage} not found in {ddsd_mask_path}')
+    return dilate_mask(image_np_zero, round(dilation * scale))
 
-def dino_prompt_detector(prompt:str, model_set, image_set):
-    find = token_first.search(prompt)
-    result_group = {}
-    result_count = 0
-    while find:
-        result_group[f'{result_count}GROUPMASK'] = dino_prompt_detector(find.group(1), model_set, image_set)
-        prompt = prompt.replace(find.group(), f' {result_count}GROUPMASK ')
-        result_count += 1
-        find = token_first.search(prompt)
-        
-    spliter = token_split.split(prompt)
-    
-    while len(spliter) > 1:
-        left, operator, right = spliter[:3]
-        if not isinstance(left, np.ndarray):
-            match = token_match.match(left.strip())
-            if match is None:
-                match = token_file.match(left)
-                if match is None:
-                    dino_text, sam_level, dino_box_threshold, dilation = prompt_spliter(left, ':', 4)
-                    left = sam_predict(model_set[0], model_set[1], image_set[0], image_set[1], image_set[2], dino_text, 
-                                    try_convert(dino_box_threshold.strip(), float, 0.3, 0, 1.0), 
-                                    try_convert(dilation.strip(), int, 16, 0, 512), 
-                                    try_convert(sam_level.strip(), int, 0, 0, 2))
-                    if left is None: left = image_set[3].copy()
-                else:
-                    left = dino_prompt_token_file(match.group(1), image_set[3].copy())
-            else:
-                left = result_group[left.strip()]
-        if not isinstance(right, np.ndarray):
-            match = token_match.match(right.strip())
-            if match is None:
-                match = token_file.match(right)
-                if match is None:
-                    dino_text, sam_level, dino_box_threshold, dilation = prompt_spliter(right, ':', 4)
-                    right = sam_predict(model_set[0], model_set[1], image_set[0], image_set[1], image_set[2], dino_text, 
-                                    try_convert(dino_box_threshold.strip(), float, 0.3, 0, 1.0), 
-                                    try_convert(dilation.strip(), int, 16, 0, 512), 
-                                    try_convert(sam_level.strip(), int, 0, 0, 2))
-                    if right is None: right = image_set[3].copy()
-                else:
-                    right = dino_prompt_token_file(match.group(1), image_set[3].copy())
-            else:
-                right = result_group[right.strip()]
-        spliter[:3] = [combine_masks(left, operator, right)]
+def dino_prompt_token_boxes(value, model_set, image_set):
+    dino_text, _, dino_box_threshold, _, _, topk = value
+    with sam_model_lock:
+        if (dino_text, dino_box_threshold) not in image_set[4]:
+            image_set[4][(dino_text, dino_box_threshold)] = dino_predict_internal(image_set[0], model_set[1], dino_text, dino_box_threshold)
+        boxes = image_set[4][(dino_text, dino_box_threshold)]
+    return boxes[:topk] if topk > 0 else boxes
+
+def dino_prompt_token_boxes_intersect(value, value2, model_set, image_set):
+    boxes = dino_prompt_token_boxes(value, model_set, image_set)
+    boxes2 = dino_prompt_token_boxes(value2, model_set, image_set)
+    if boxes.shape[0] < 1 or boxes2.shape[0] < 1: return False
+    boxes = boxes + torch.Tensor([-value[3], -value[3], value[3], value[3]])
+    boxes2 = boxes2 + torch.Tensor([-value2[3], -value2[3], value2[3], value2[3]])
+    w = torch.min(boxes[:, None, 2], boxes2[None, :, 2]) - torch.max(boxes[:, None, 0], boxes2[None, :, 0])
+    h = torch.min(boxes[:, None, 3], boxes2[None, :, 3]) - torch.max(boxes[:, None, 1], boxes2[None, :, 1])
+    return bool(((w > 0) & (h > 0)).any())
+
+def dino_prompt_token_leaf(value, model_set, image_set, mask_set):
+    dino_text, sam_level, dino_box_threshold, dilation, mask_mode, _ = value
+    target = sam_predict(model_set[0], model_set[1], image_set[0], image_set[1], image_set[2], dino_text, 
+                                    dino_box_threshold, 
+                                    dilation, 
+                                    sam_level,
+                                    mask_mode,
+                                    model_set[2],
+                                    dino_prompt_token_boxes(value, model_set, image_set),
+                                    model_set[3],
+                                    mask_set.name == 'Torch')
+    with sam_model_lock:
         gc.collect()
         torch_gc()
-    if isinstance(spliter[0], np.ndarray): return spliter[0]
-    match = token_file.match(spliter[0])
-    if match is None:
-        dino_text, sam_level, dino_box_threshold, dilation = prompt_spliter(spliter[0], ':', 4)
-        target = sam_predict(model_set[0], model_set[1], image_set[0], image_set[1], image_set[2], dino_text, 
-                                    try_convert(dino_box_threshold.strip(), float, 0.3, 0, 1.0), 
-                                    try_convert(dilation.strip(), int, 16, 0, 512), 
-                                    try_convert(sam_level.strip(), int, 0, 0, 2))
-        if target is None: return image_set[3].copy()
-    else:
-        target = dino_prompt_token_file(match.group(1), image_set[3].copy())
-    return target
+    if target is None: return mask_set.empty(image_set[3])
+    return mask_set.wrap(target)
+
+def dino_leaf_pool():
+    workers = shared.opts.data.get('ddsd_leaf_workers', 0)
+    if workers != leaf_pool[0]:
+        if leaf_pool[1] is not None: leaf_pool[1].shutdown(wait=True)
+        leaf_pool[:] = [workers, ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ddsd_leaf') if workers > 0 else None]
+    return leaf_pool[1]
+
+# With a leaf pool the leaves evaluate_plan will need anyway run on worker
+# threads while it combines, DINO/SAM inference stays behind sam_model_lock.
+def dino_prompt_detector(prompt:str, model_set, image_set, mask_set, job=None):
+    plan = compile_expression(prompt)
+    pool = dino_leaf_pool()
+    futures = {}
+
+    def prefetch(values):
+        for value in values:
+            if value not in futures: futures[value] = pool.submit(dino_prompt_token_leaf, value, model_set, image_set, mask_set)
 
-def mask_spliter_and_remover(mask, area):
+    def leaf(value):
+        if value in futures: return futures.pop(value).result()
+        return dino_prompt_token_leaf(value, model_set, image_set, mask_set)
+
+    backend = ExprBackend(
+        mask_set.name,
+        leaf,
+        lambda value, shape: mask_set.wrap(dino_prompt_token_file(value, shape, model_set[3])),
+        mask_set.combine,
+        mask_set.empty,
+        mask_set.is_empty,
+        mask_set.is_full,
+        lambda value, value2: dino_prompt_token_boxes_intersect(value, value2, model_set, image_set),
+        lambda mask, value: mask_set.wrap(select_regions(mask_set.unwrap(mask), value)),
+        prefetch if pool is not None else None
+    )
+    try:
+        return evaluate_plan(plan, image_set[3], backend, job)
+    finally:
+        wait(list(futures.values()))
+
+# Connected regions of mask with at least area pixels, largest first, as
+# RegionMask so the full frame is only built for the region being inpainted.
+# With max_regions the smallest regions share the last pass.
+def mask_spliter_and_remover(mask, area, max_regions=0):
     gc.collect()
     torch_gc()
-    labels = measure.label(mask)
-    regions = measure.regionprops(labels)
-    
-    for r in regions:
-        if r.area < area:
-            for coord in r.coords:
-                labels[coord[0], coord[1]] = 0
-    
-    num_labels = np.max(labels)
+    scale = shared.opts.data.get('ddsd_mask_scale', 1.0)
+    x, y, w, h = cv2.boundingRect(mask)
+    crop = mask[y:y + h, x:x + w]
+    if crop.size < 1: return []
+    shape = mask_work_shape(crop.shape, scale) if scale < 1 else crop.shape
+    # first full size row/column of every working row/column
+    rows = -(-np.arange(shape[0] + 1) * h // shape[0])
+    cols = -(-np.arange(shape[1] + 1) * w // shape[1])
+    work = crop
+    if scale < 1:
+        work = np.maximum.reduceat(np.maximum.reduceat(crop, rows[:-1], axis=0), cols[:-1], axis=1)
+        area = area * scale * scale
+    count, labels, stats, _ = cv2.connectedComponentsWithStats((work > 0).astype(np.uint8), connectivity=8)
+    keep = np.flatnonzero(stats[1:, cv2.CC_STAT_AREA] >= area) + 1
+    keep = keep[np.argsort(-stats[keep, cv2.CC_STAT_AREA], kind='stable')]
+    if work.shape != crop.shape:
+        labels = labels[(np.arange(h) * work.shape[0] // h)[:, None], (np.arange(w) * work.shape[1] // w)[None, :]]
+        labels[crop == 0] = 0
     
-    label_images = []
-    for x in range(num_labels):
-        label_image = np.zeros_like(mask, dtype=np.uint8)
-        label_image[labels == (x + 1)] = 255
-        label_images.append(label_image)
-    return label_images
+    regions = []
+    for index in keep:
+        left, top, width, height = stats[index, :4]
+        y0, y1, x0, x1 = rows[top], rows[top + height], cols[left], cols[left + width]
+        region = (labels[y0:y1, x0:x1] == index).astype(np.uint8) * np.uint8(255)
+        regions.append(RegionMask((y + y0, x + x0, y + y1, x + x1), region, mask.shape[:2]))
+    if max_regions > 0 and len(regions) > max_regions:
+        rest = regions[max_regions - 1]
+        for region in regions[max_regions:]: rest = region_combine(rest, 'OR', region)
+        regions = regions[:max_regions - 1] + [rest]
+    return regions
     
 def I2I_Generator_Create(p, i2i_sample, i2i_mask_blur, full_res_inpainting, inpainting_padding, init_image, denoise, cfg, steps, width, height, tiling, scripts, scripts_list, alwaysonscripts_list, script_args, positive, negative):
-    i2i = StableDiffusionProcessingImg2Img(
+    i2i = LatentCarryProcessing(
                 init_images = [init_image],
                 resize_mode = 0,
                 denoising_strength = 0,
@@ -0,0 +1,136 @@
+import re
+import json
+import cv2
+import numpy as np
+import xml.etree.ElementTree as ET
+
+# Vector FILE masks, coordinates are normalized to 0-1 of the mask width/height.
+# JSON is a list of shapes (or {"shapes": [...]}):
+#   {"type": "polygon", "points": [[x, y], ...]}
+#   {"type": "rect", "box": [x0, y0, x1, y1]}
+#   {"type": "ellipse", "center": [x, y], "axes": [rx, ry], "angle": 0}
+# SVG uses the viewBox (or width/height) as the unit square and supports path
+# (M/L/H/V/Z, absolute and relative), polygon, rect, circle and ellipse.
+vector_ext = ['.json', '.svg']
+token_svg_path = re.compile(r'([A-Za-z])|(-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+token_svg_number = re.compile(r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+def vector_polygon(points):
+    return ('POLYGON', np.array(points, dtype=np.float64).reshape(-1, 2))
+
+def vector_ellipse(cx, cy, rx, ry, angle=0):
+    return ('ELLIPSE', (float(cx), float(cy), float(rx), float(ry), float(angle)))
+
+def load_json_vector(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    shapes = []
+    for shape in data.get('shapes', []) if isinstance(data, dict) else data:
+        if not isinstance(shape, dict):
+            print(f'Skip vector mask entry {shape!r} in {path}, shapes have to be objects')
+            continue
+        shape_type = str(shape.get('type', 'polygon')).lower()
+        if shape_type == 'polygon':
+            shapes.append(vector_polygon(shape['points']))
+        elif shape_type == 'rect':
+            x0, y0, x1, y1 = shape['box']
+            shapes.append(vector_polygon([[x0, y0], [x1, y0], [x1, y1], [x0, y1]]))
+        elif shape_type == 'ellipse':
+            shapes.append(vector_ellipse(*shape['center'], *shape['axes'], shape.get('angle', 0)))
+        else:
+            print(f'Unknown vector mask shape {shape_type} in {path}')
+    return shapes
+
+def svg_float(element, name, default=0.0):
+    match = token_svg_number.match(element.get(name, ''))
+    return float(match.group(0)) if match else default
+
+# Curves and arcs are not supported, a path using them is dropped with a warning
+# instead of turning its control points into polygon vertices.
+def svg_path(data):
+    polygons, points, x, y, start, command = [], [], 0.0, 0.0, (0.0, 0.0), 'M'
+    tokens = [(c, float(n) if n else None) for c, n in token_svg_path.findall(data)]
+    unknown = sorted(set(c for c, _ in tokens if c and c not in 'MmLlHhVvZz'))
+    if unknown:
+        print(f'Skip vector mask path with unsupported commands {unknown}')
+        return []
+    index = 0
+    while index < len(tokens):
+        if tokens[index][0]:
+            command = tokens[index][0]
+            index += 1
+            if command in 'Zz':
+                if len(points) > 2: polygons.append(vector_polygon(points))
+                points, (x, y) = [start], start
+                continue
+        if command in 'HhVv':
+            value = tokens[index][1]
+            index += 1
+            if command == 'H': x = value
+            elif command == 'h': x += value
+            elif command == 'V': y = value
+            else: y += value
+        else:
+            dx, dy = tokens[index][1], tokens[index + 1][1]
+            index += 2
+            if command in 'Mm' and len(points) > 2: polygons.append(vector_polygon(points))
+            if command in 'Mm': points = []
+            x, y = (x + dx, y + dy) if command.islower() else (dx, dy)
+            if command in 'Mm': start = (x, y)
+            if command == 'M': command = 'L'
+            elif command == 'm': command = 'l'
+        points.append((x, y))
+    if len(points) > 2: polygons.append(vector_polygon(points))
+    return polygons
+
+def load_svg_vector(path):
+    root = ET.parse(path).getroot()
+    view_box = [float(x) for x in token_svg_number.findall(root.get('viewBox', ''))]
+    if len(view_box) != 4:
+        view_box = [0.0, 0.0, svg_float(root, 'width', 1.0), svg_float(root, 'height', 1.0)]
+    shapes = []
+    for element in root.iter():
+        tag = element.tag.split('}')[-1]
+        if tag == 'path':
+            shapes.extend(svg_path(element.get('d', '')))
+        elif tag in ['polygon', 'polyline']:
+            shapes.append(vector_polygon([float(x) for x in token_svg_number.findall(element.get('points', ''))]))
+        elif tag == 'rect':
+            x, y, w, h = (svg_float(element, n) for n in ['x', 'y', 'width', 'height'])
+            shapes.append(vector_polygon([[x, y], [x + w, y], [x + w, y + h], [x, y + h]]))
+        elif tag == 'circle':
+            shapes.append(vector_ellipse(svg_float(element, 'cx'), svg_float(element, 'cy'), svg_float(element, 'r'), svg_float(element, 'r')))
+        elif tag == 'ellipse':
+            shapes.append(vector_ellipse(*(svg_float(element, n) for n in ['cx', 'cy', 'rx', 'ry'])))
+    origin, size = np.array(view_box[:2]), np.maximum(np.array(view_box[2:]), 1e-6)
+    result = []
+    for shape_type, value in shapes:
+        if shape_type == 'POLYGON':
+            result.append(('POLYGON', (value - origin) / size))
+        else:
+            cx, cy, rx, ry, angle = value
+            result.append(vector_ellipse((cx - origin[0]) / size[0], (cy - origin[1]) / size[1], rx / size[0], ry / size[1], angle))
+    return result
+
+def load_vector_mask(path):
+    try:
+        if path.lower().endswith('.svg'): return load_svg_vector(path)
+        return load_json_vector(path)
+    except (OSError, ValueError, KeyError, TypeError, IndexError, AttributeError, ET.ParseError) as e:
+        print(f'Vector mask {path} could not be read: {e}')
+        return []
+
+# Rasterized straight at the target size with 4 bits of subpixel precision, each
+# shape is filled on its own so overlapping shapes union instead of cancelling.
+def rasterize_vector_mask(shapes, shape):
+    h, w = shape[:2]
+    mask = np.zeros((h, w), dtype=np.uint8)
+    size = np.array([w, h], dtype=np.float64)
+    for shape_type, value in shapes:
+        if shape_type == 'POLYGON' and len(value) > 2:
+            cv2.fillPoly(mask, [np.round(value * size * 16).astype(np.int32)], 255, cv2.LINE_8, 4)
+    for shape_type, value in shapes:
+        if shape_type != 'ELLIPSE': continue
+        cx, cy, rx, ry, angle = value
+        cv2.ellipse(mask, (round(cx * w * 16), round(cy * h * 16)), (round(rx * w * 16), round(ry * h * 16)), angle, 0, 360, 255, -1, cv2.LINE_8, 4)
+    return mask
@@ -2,7 +2,6 @@ import os
 import numpy as np
 import torch
 import gc
-import cv2
 
 from modules import shared
 from modules.paths import models_path
@@ -14,6 +13,7 @@ from collections import OrderedDict
 from scipy.ndimage import binary_dilation
 from segment_anything import SamPredictor, sam_model_registry
 from scripts.dino import dino_predict_internal, clear_dino_cache
+from scripts.ddsd_morph import dilate
 
 sam_model_cache = OrderedDict()
 sam_model_dir = os.path.join(models_path, "sam")
@@ -41,8 +41,7 @@ def clear_cache():
     clear_dino_cache()
 
 def dilate_mask(mask, dilation):
-    dilation_kernel = np.ones((dilation, dilation), np.uint8)
-    return cv2.dilate(mask, dilation_kernel)
+    return dilate(mask, dilation)
 
 def init_sam_model(sam_model_name):
     print('Initializing SAM')
@@ -11,6 +11,7 @@ from mmdet.apis import (inference_detector,
                         init_detector)
 
 from modules.sd_models import model_hash
+from scripts.ddsd_morph import dilate
      
 dd_models_path = os.path.join(models_path, "mmdet")
 grounding_models_path = os.path.join(models_path, "grounding")
@@ -92,10 +93,9 @@ def dilate_masks(masks, dilation_factor, iter=1):
     if dilation_factor == 0:
         return masks
     dilated_masks = []
-    kernel = np.ones((dilation_factor,dilation_factor), np.uint8)
     for i in range(len(masks)):
         cv2_mask = np.array(masks[i])
-        dilated_mask = cv2.dilate(cv2_mask, kernel, iter)
+        dilated_mask = dilate(cv2_mask, iter * (dilation_factor - 1) + 1)
         dilated_masks.append(Image.fromarray(dilated_mask))
     return dilated_masks
 
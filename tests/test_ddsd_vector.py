@@ -0,0 +1,38 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.ddsd_vector import load_vector_mask, rasterize_vector_mask
+
+
+def write_json(tmp_path, data):
+    path = tmp_path / "mask.json"
+    path.write_text(json.dumps(data), encoding="utf-8")
+    return str(path)
+
+
+def test_json_non_object_entries_are_skipped(tmp_path):
+    path = write_json(tmp_path, [1, "a", {"type": "rect", "box": [0, 0, 0.5, 0.5]}])
+    shapes = load_vector_mask(path)
+    assert len(shapes) == 1
+    mask = rasterize_vector_mask(shapes, (100, 100))
+    assert mask[25, 25] == 255 and mask[75, 75] == 0
+
+
+def test_json_only_non_object_entries(tmp_path):
+    assert load_vector_mask(write_json(tmp_path, [1])) == []
+    assert load_vector_mask(write_json(tmp_path, {"shapes": ["a"]})) == []
+
+
+def test_overlapping_shapes_union(tmp_path):
+    path = write_json(
+        tmp_path,
+        [
+            {"type": "rect", "box": [0, 0, 0.6, 0.6]},
+            {"type": "rect", "box": [0.4, 0.4, 1, 1]},
+        ],
+    )
+    mask = rasterize_vector_mask(load_vector_mask(path), (100, 100))
+    assert mask[50, 50] == 255